@@ -2,6 +2,8 @@
 Analytics models for tracking metrics
 """
 from django.db import models
+from django.db.models import Case, Value, When
+from django.db.models.functions import Cast
 from django.contrib.auth.models import User
 from django.utils import timezone
 from apps.emails.models import EmailCategory
@@ -26,13 +28,38 @@ class DailyMetrics(models.Model):
     # Response times (in hours)
     avg_response_time = models.FloatField(null=True, blank=True)
     median_response_time = models.FloatField(null=True, blank=True)
+    # Emails avg_response_time was taken over, for weighting across days
+    response_time_count = models.IntegerField(default=0)
     
     # Escalations
     total_escalations = models.IntegerField(default=0)
     
     # Cost savings (estimated)
     estimated_time_saved_hours = models.FloatField(default=0)
-    estimated_cost_saved = models.DecimalField(max_digits=10, decimal_places=2, default=0)
+    estimated_cost_saved_cents = models.IntegerField(default=0)
+    
+    # Derived rates (percent), stored so they can be filtered, ordered and aggregated
+    ai_approval_rate = models.GeneratedField(
+        expression=Case(
+            When(ai_suggested_replies=0, then=Value(0.0)),
+            default=Value(100.0) * Cast('ai_approved_replies', models.FloatField())
+            / Cast('ai_suggested_replies', models.FloatField()),
+        ),
+        output_field=models.FloatField(),
+        db_persist=True,
+    )
+    automation_rate = models.GeneratedField(
+        expression=Case(
+            When(total_emails_processed=0, then=Value(0.0)),
+            default=Value(100.0) * Cast('ai_approved_replies', models.FloatField())
+            / Cast('total_emails_processed', models.FloatField()),
+        ),
+        output_field=models.FloatField(),
+        db_persist=True,
+    )
+    
+    # Set while the day is still in progress and refreshed hourly
+    is_partial = models.BooleanField(default=False)
     
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
@@ -43,20 +70,6 @@ class DailyMetrics(models.Model):
     
     def __str__(self):
         return f"Metrics for {self.date}"
-    
-    @property
-    def ai_approval_rate(self):
-        """Calculate AI approval rate"""
-        if self.ai_suggested_replies == 0:
-            return 0
-        return (self.ai_approved_replies / self.ai_suggested_replies) * 100
-    
-    @property
-    def automation_rate(self):
-        """Calculate automation rate"""
-        if self.total_emails_processed == 0:
-            return 0
-        return (self.ai_approved_replies / self.total_emails_processed) * 100
 
 
 class CategoryMetrics(models.Model):
@@ -2,103 +2,174 @@
 Analytics tasks for generating metrics
 """
 import logging
-from celery import shared_task
+from celery import chord, shared_task
 from django.utils import timezone
-from django.db.models import Avg, Count, Sum, F
+from django.db import transaction
+from django.db.models import Avg, Count, F, Q, ExpressionWrapper, DurationField
+from django.db.models.functions import TruncDate
 from datetime import timedelta
-from decimal import Decimal
 
 from apps.analytics.models import DailyMetrics, CategoryMetrics, AgentPerformance
-from apps.emails.models import Email, EmailReply, EmailCategory
+from apps.analytics.utils import day_range, try_advisory_lock
+from apps.emails.models import EMAIL_RESPONSE_SECONDS_EXPRESSION, Email, EmailReply
 
 logger = logging.getLogger(__name__)
 
 
-@shared_task
-def generate_daily_metrics_task(date=None):
+def _resolve_target_date(date):
+    """Resolve the task date argument: None (yesterday), 'today', an ISO string or a date"""
+    today = timezone.now().date()
+    if not date:
+        return today - timedelta(days=1)
+    if date == 'today':
+        return today
+    if isinstance(date, str):
+        return timezone.datetime.fromisoformat(date).date()
+    return date
+
+
+# Estimate time saved (assume 10 minutes per manual email)
+MINUTES_PER_EMAIL = 10
+
+# Estimate cost saved (assume $30/hour for support agent)
+HOURLY_RATE = 30
+
+DAILY_METRICS_UPDATE_FIELDS = [
+    'total_emails_received', 'total_emails_processed', 'total_emails_replied',
+    'ai_suggested_replies', 'ai_approved_replies', 'ai_modified_replies',
+    'ai_rejected_replies', 'total_escalations', 'avg_response_time',
+    'response_time_count', 'estimated_time_saved_hours', 'estimated_cost_saved_cents', 'is_partial', 'updated_at',
+]
+
+
+def _build_daily_metrics(start_date, end_date):
     """
-    Generate daily metrics for analytics
+    Roll up emails and replies into one DailyMetrics row per day in [start_date, end_date]
+    
+    Two GROUP BY day queries cover the whole range, so rebuilding a month
+    costs the same number of queries as refreshing a single day.
     """
-    try:
-        target_date = date or timezone.now().date() - timedelta(days=1)
-        
-        logger.info(f"Generating metrics for {target_date}")
-        
-        # Get emails for the date
-        emails = Email.objects.filter(received_at__date=target_date)
-        
-        # Count emails by status
-        total_received = emails.count()
-        total_processed = emails.exclude(processed_at__isnull=True).count()
-        total_replied = emails.filter(status='replied').count()
-        total_escalations = emails.filter(requires_escalation=True).count()
-        
-        # Get reply statistics
-        replies = EmailReply.objects.filter(created_at__date=target_date)
-        
-        ai_suggested = replies.filter(source='ai').count()
-        ai_approved = replies.filter(source='ai', status='approved').count()
-        ai_modified = replies.filter(source='ai_modified').count()
-        ai_rejected = replies.filter(source='ai', status='rejected').count()
-        
-        # Calculate average response time
-        replied_emails = emails.filter(
-            replied_at__isnull=False
+    range_start, _ = day_range(start_date)
+    _, range_end = day_range(end_date)
+    today = timezone.now().date()
+    
+    # Email volume, escalations and average response time per day
+    email_stats = {
+        row['day']: row
+        for row in Email.objects.filter(
+            received_at__gte=range_start,
+            received_at__lt=range_end
+        ).annotate(
+            day=TruncDate('received_at')
+        ).values('day').annotate(
+            received=Count('id'),
+            processed=Count('id', filter=Q(processed_at__isnull=False)),
+            replied=Count('id', filter=Q(status='replied')),
+            escalations=Count('id', filter=Q(requires_escalation=True)),
+            # Avg() skips unreplied emails and yields None when there are none
+            avg_response=Avg(EMAIL_RESPONSE_SECONDS_EXPRESSION),
+            responded=Count(EMAIL_RESPONSE_SECONDS_EXPRESSION),
+        )
+    }
+    
+    # Reply outcomes per day
+    reply_stats = {
+        row['day']: row
+        for row in EmailReply.objects.filter(
+            created_at__gte=range_start,
+            created_at__lt=range_end
         ).annotate(
-            response_time_seconds=(
-                F('replied_at') - F('received_at')
-            ).total_seconds()
+            day=TruncDate('created_at')
+        ).values('day').annotate(
+            suggested=Count('id', filter=Q(source='ai')),
+            approved=Count('id', filter=Q(source='ai', status='approved')),
+            modified=Count('id', filter=Q(source='ai_modified')),
+            rejected=Count('id', filter=Q(source='ai', status='rejected')),
         )
+    }
+    
+    rows = []
+    day = start_date
+    while day <= end_date:
+        emails = email_stats.get(day, {})
+        replies = reply_stats.get(day, {})
         
         avg_response_time = None
-        if replied_emails.exists():
-            avg_seconds = replied_emails.aggregate(
-                avg=Avg('response_time_seconds')
-            )['avg']
-            if avg_seconds:
-                avg_response_time = avg_seconds / 3600  # Convert to hours
+        if emails.get('avg_response') is not None:
+            avg_response_time = emails['avg_response'] / 3600
         
-        # Estimate time saved (assume 10 minutes per manual email)
-        minutes_per_email = 10
-        time_saved_hours = (ai_approved * minutes_per_email) / 60
+        ai_approved = replies.get('approved', 0)
+        time_saved_hours = (ai_approved * MINUTES_PER_EMAIL) / 60
         
-        # Estimate cost saved (assume $30/hour for support agent)
-        hourly_rate = 30
-        cost_saved = Decimal(time_saved_hours * hourly_rate)
+        rows.append(DailyMetrics(
+            date=day,
+            total_emails_received=emails.get('received', 0),
+            total_emails_processed=emails.get('processed', 0),
+            total_emails_replied=emails.get('replied', 0),
+            ai_suggested_replies=replies.get('suggested', 0),
+            ai_approved_replies=ai_approved,
+            ai_modified_replies=replies.get('modified', 0),
+            ai_rejected_replies=replies.get('rejected', 0),
+            total_escalations=emails.get('escalations', 0),
+            avg_response_time=avg_response_time,
+            response_time_count=emails.get('responded', 0),
+            estimated_time_saved_hours=time_saved_hours,
+            # Integer cents straight from the counts, no float rounding
+            estimated_cost_saved_cents=ai_approved * MINUTES_PER_EMAIL * HOURLY_RATE * 100 // 60,
+            is_partial=day >= today,
+        ))
+        day += timedelta(days=1)
+    
+    return rows
+
+
+def _save_daily_metrics(rows):
+    """Upsert DailyMetrics rows with a single INSERT ... ON CONFLICT DO UPDATE"""
+    DailyMetrics.objects.bulk_create(
+        rows,
+        update_conflicts=True,
+        unique_fields=['date'],
+        update_fields=DAILY_METRICS_UPDATE_FIELDS,
+    )
+
+
+@shared_task
+def generate_daily_metrics_task(date=None):
+    """
+    Generate daily metrics for analytics
+    
+    Runs nightly for the previous day and hourly with date='today' to keep
+    the current day's partial row fresh.
+    """
+    try:
+        target_date = _resolve_target_date(date)
         
-        # Create or update daily metrics
-        metrics, created = DailyMetrics.objects.update_or_create(
-            date=target_date,
-            defaults={
-                'total_emails_received': total_received,
-                'total_emails_processed': total_processed,
-                'total_emails_replied': total_replied,
-                'ai_suggested_replies': ai_suggested,
-                'ai_approved_replies': ai_approved,
-                'ai_modified_replies': ai_modified,
-                'ai_rejected_replies': ai_rejected,
-                'total_escalations': total_escalations,
-                'avg_response_time': avg_response_time,
-                'estimated_time_saved_hours': time_saved_hours,
-                'estimated_cost_saved': cost_saved,
-            }
-        )
+        logger.info(f"Generating metrics for {target_date}")
         
-        logger.info(f"{'Created' if created else 'Updated'} metrics for {target_date}")
+        with transaction.atomic():
+            # Another worker is already refreshing this day
+            if not try_advisory_lock(f'daily_metrics:{target_date}'):
+                logger.info(f"Metrics for {target_date} are already being generated, skipping")
+                return {'success': True, 'skipped': True, 'date': str(target_date)}
+            
+            metrics = _build_daily_metrics(target_date, target_date)[0]
+            _save_daily_metrics([metrics])
         
-        # Generate category metrics
-        generate_category_metrics_task.delay(str(target_date))
+        logger.info(f"Saved metrics for {target_date}")
         
-        # Generate agent performance metrics
-        generate_agent_performance_task.delay(str(target_date))
+        # Category and agent metrics run in parallel with a single completion callback
+        chord([
+            generate_category_metrics_task.s(str(target_date)),
+            generate_agent_performance_task.s(str(target_date)),
+        ])(mark_metrics_complete_task.s(str(target_date)))
         
         return {
             'success': True,
             'date': str(target_date),
             'metrics': {
-                'total_received': total_received,
-                'ai_approved': ai_approved,
-                'time_saved_hours': round(time_saved_hours, 2),
+                'total_received': metrics.total_emails_received,
+                'ai_approved': metrics.ai_approved_replies,
+                'time_saved_hours': round(metrics.estimated_time_saved_hours, 2),
             }
         }
         
@@ -108,68 +179,130 @@ def generate_daily_metrics_task(date=None):
 
 
 @shared_task
+def mark_metrics_complete_task(results, date_str):
+    """
+    Chord callback run once category and agent metrics have both finished
+    """
+    failed = [result.get('error') for result in results if not result.get('success')]
+    
+    if failed:
+        logger.error(f"Metrics for {date_str} finished with errors: {failed}")
+        return {'success': False, 'date': date_str, 'errors': failed}
+    
+    logger.info(f"All metrics for {date_str} are up to date")
+    return {'success': True, 'date': date_str}
+
+
+@shared_task
+def rebuild_daily_metrics_task(start_date_str, end_date_str):
+    """
+    Recompute DailyMetrics for every day in a date range (inclusive)
+    
+    Used for backfills after data corrections; the whole range is rolled up
+    with the same two grouped queries as a single day.
+    """
+    try:
+        start_date = timezone.datetime.fromisoformat(start_date_str).date()
+        end_date = timezone.datetime.fromisoformat(end_date_str).date()
+        
+        days = [
+            start_date + timedelta(days=offset)
+            for offset in range((end_date - start_date).days + 1)
+        ]
+        
+        with transaction.atomic():
+            # Skip if any day in the range is being refreshed by another worker
+            if not all(try_advisory_lock(f'daily_metrics:{day}') for day in days):
+                logger.info(f"Metrics for {start_date}..{end_date} are being generated, skipping")
+                return {'success': True, 'skipped': True}
+            
+            rows = _build_daily_metrics(start_date, end_date)
+            _save_daily_metrics(rows)
+        
+        logger.info(f"Rebuilt daily metrics for {len(rows)} days ({start_date}..{end_date})")
+        return {'success': True, 'days': len(rows)}
+        
+    except Exception as e:
+        logger.error(f"Error rebuilding daily metrics: {e}")
+        return {'success': False, 'error': str(e)}
+
+
+@shared_task(ignore_result=False)  # chord header; mark_metrics_complete_task reads it
 def generate_category_metrics_task(date_str):
     """
     Generate metrics by category
     """
     try:
         target_date = timezone.datetime.fromisoformat(date_str).date()
+        day_start, day_end = day_range(target_date)
         
-        categories = EmailCategory.objects.all()
-        
-        for category in categories:
-            emails = Email.objects.filter(
-                received_at__date=target_date,
-                category=category
-            )
-            
-            email_count = emails.count()
-            
-            if email_count == 0:
-                continue
-            
-            # Calculate average response time
-            replied = emails.filter(replied_at__isnull=False)
-            avg_response = None
-            if replied.exists():
-                avg_seconds = sum(
-                    (e.replied_at - e.received_at).total_seconds() 
-                    for e in replied
-                ) / replied.count()
-                avg_response = avg_seconds / 3600
+        with transaction.atomic():
+            if not try_advisory_lock(f'category_metrics:{target_date}'):
+                logger.info(f"Category metrics for {target_date} are already being generated, skipping")
+                return {'success': True, 'skipped': True}
             
-            # Calculate AI success rate
-            total_replies = EmailReply.objects.filter(
-                email__in=emails,
-                source='ai'
-            ).count()
-            
-            approved_replies = EmailReply.objects.filter(
-                email__in=emails,
-                source='ai',
-                status='approved'
-            ).count()
+            # Volume, response time and escalations for every category in one query
+            email_stats = Email.objects.filter(
+                received_at__gte=day_start,
+                received_at__lt=day_end,
+                category__isnull=False
+            ).values('category_id').annotate(
+                email_count=Count('id'),
+                avg_response=Avg(EMAIL_RESPONSE_SECONDS_EXPRESSION),
+                escalations=Count('id', filter=Q(requires_escalation=True)),
+            )
             
-            ai_success_rate = 0
-            if total_replies > 0:
-                ai_success_rate = (approved_replies / total_replies) * 100
+            # AI reply outcomes per category, joined through the email
+            reply_stats = {
+                row['email__category_id']: row
+                for row in EmailReply.objects.filter(
+                    email__received_at__gte=day_start,
+                    email__received_at__lt=day_end,
+                    email__category__isnull=False,
+                    source='ai'
+                ).values('email__category_id').annotate(
+                    total=Count('id'),
+                    approved=Count('id', filter=Q(status='approved')),
+                )
+            }
             
-            # Escalation rate
-            escalations = emails.filter(requires_escalation=True).count()
-            escalation_rate = (escalations / email_count) * 100
+            rows = []
+            for row in email_stats:
+                category_id = row['category_id']
+                email_count = row['email_count']
+                
+                avg_response = None
+                if row['avg_response'] is not None:
+                    avg_response = row['avg_response'] / 3600
+                
+                # Calculate AI success rate
+                replies = reply_stats.get(category_id)
+                ai_success_rate = 0
+                if replies and replies['total'] > 0:
+                    ai_success_rate = (replies['approved'] / replies['total']) * 100
+                
+                # Escalation rate
+                escalation_rate = (row['escalations'] / email_count) * 100
+                
+                rows.append(CategoryMetrics(
+                    date=target_date,
+                    category_id=category_id,
+                    email_count=email_count,
+                    avg_response_time=avg_response,
+                    ai_success_rate=ai_success_rate,
+                    escalation_rate=escalation_rate,
+                ))
             
-            # Create or update
-            CategoryMetrics.objects.update_or_create(
-                date=target_date,
-                category=category,
-                defaults={
-                    'email_count': email_count,
-                    'avg_response_time': avg_response,
-                    'ai_success_rate': ai_success_rate,
-                    'escalation_rate': escalation_rate,
-                }
+            # Single INSERT ... ON CONFLICT DO UPDATE for every category
+            CategoryMetrics.objects.bulk_create(
+                rows,
+                update_conflicts=True,
+                unique_fields=['date', 'category'],
+                update_fields=[
+                    'email_count', 'avg_response_time', 'ai_success_rate', 'escalation_rate',
+                ]
             )
-        
+            
         logger.info(f"Generated category metrics for {target_date}")
         return {'success': True}
         
@@ -178,7 +311,7 @@ def generate_category_metrics_task(date_str):
         return {'success': False, 'error': str(e)}
 
 
-@shared_task
+@shared_task(ignore_result=False)  # chord header; mark_metrics_complete_task reads it
 def generate_agent_performance_task(date_str):
     """
     Generate agent performance metrics
@@ -187,67 +320,87 @@ def generate_agent_performance_task(date_str):
         from django.contrib.auth.models import User
         
         target_date = timezone.datetime.fromisoformat(date_str).date()
+        day_start, day_end = day_range(target_date)
         
-        agents = User.objects.filter(is_staff=True, is_active=True)
-        
-        for agent in agents:
-            # Get emails handled by agent
-            emails_handled = Email.objects.filter(
-                assigned_to=agent,
-                assigned_at__date=target_date
-            ).count()
-            
-            # Get replies reviewed by agent
-            replies = EmailReply.objects.filter(
-                reviewed_by=agent,
-                reviewed_at__date=target_date
-            )
-            
-            ai_approved = replies.filter(
-                source='ai',
-                status='approved'
-            ).count()
+        with transaction.atomic():
+            if not try_advisory_lock(f'agent_performance:{target_date}'):
+                logger.info(f"Agent performance for {target_date} is already being generated, skipping")
+                return {'success': True, 'skipped': True}
             
-            ai_modified = replies.filter(
-                source='ai_modified'
-            ).count()
+            agent_ids = User.objects.filter(
+                is_staff=True,
+                is_active=True
+            ).values_list('id', flat=True)
             
-            ai_rejected = replies.filter(
-                source='ai',
-                status='rejected'
-            ).count()
+            # Emails assigned per agent
+            emails_handled = dict(
+                Email.objects.filter(
+                    assigned_at__gte=day_start,
+                    assigned_at__lt=day_end,
+                    assigned_to__isnull=False
+                ).values_list('assigned_to_id').annotate(count=Count('id'))
+            )
             
-            manual_replies = EmailReply.objects.filter(
-                created_by=agent,
-                created_at__date=target_date,
-                source='human'
-            ).count()
+            # Review outcomes and average review time per reviewer
+            reviews = {
+                row['reviewed_by_id']: row
+                for row in EmailReply.objects.filter(
+                    reviewed_at__gte=day_start,
+                    reviewed_at__lt=day_end,
+                    reviewed_by__isnull=False
+                ).values('reviewed_by_id').annotate(
+                    ai_approved=Count('id', filter=Q(source='ai', status='approved')),
+                    ai_modified=Count('id', filter=Q(source='ai_modified')),
+                    ai_rejected=Count('id', filter=Q(source='ai', status='rejected')),
+                    avg_review=Avg(
+                        ExpressionWrapper(
+                            F('reviewed_at') - F('created_at'),
+                            output_field=DurationField()
+                        )
+                    ),
+                )
+            }
             
-            # Calculate average review time
-            reviewed_replies = replies.exclude(reviewed_at__isnull=True)
-            avg_review_time = None
+            # Manually written replies per author
+            manual_replies = dict(
+                EmailReply.objects.filter(
+                    created_at__gte=day_start,
+                    created_at__lt=day_end,
+                    source='human',
+                    created_by__isnull=False
+                ).values_list('created_by_id').annotate(count=Count('id'))
+            )
             
-            if reviewed_replies.exists():
-                total_seconds = sum(
-                    (r.reviewed_at - r.created_at).total_seconds()
-                    for r in reviewed_replies
-                )
-                avg_review_time = (total_seconds / reviewed_replies.count()) / 60  # Minutes
+            rows = []
+            for agent_id in agent_ids:
+                review = reviews.get(agent_id, {})
+                
+                avg_review_time = None
+                if review.get('avg_review') is not None:
+                    avg_review_time = review['avg_review'] / timedelta(minutes=1)
+                
+                rows.append(AgentPerformance(
+                    agent_id=agent_id,
+                    date=target_date,
+                    emails_handled=emails_handled.get(agent_id, 0),
+                    ai_replies_approved=review.get('ai_approved', 0),
+                    ai_replies_modified=review.get('ai_modified', 0),
+                    ai_replies_rejected=review.get('ai_rejected', 0),
+                    manual_replies=manual_replies.get(agent_id, 0),
+                    avg_review_time=avg_review_time,
+                ))
             
-            # Create or update
-            AgentPerformance.objects.update_or_create(
-                agent=agent,
-                date=target_date,
-                defaults={
-                    'emails_handled': emails_handled,
-                    'ai_replies_approved': ai_approved,
-                    'ai_replies_modified': ai_modified,
-                    'ai_replies_rejected': ai_rejected,
-                    'manual_replies': manual_replies,
-                    'avg_review_time': avg_review_time,
-                }
+            # Single INSERT ... ON CONFLICT DO UPDATE for every agent
+            AgentPerformance.objects.bulk_create(
+                rows,
+                update_conflicts=True,
+                unique_fields=['agent', 'date'],
+                update_fields=[
+                    'emails_handled', 'ai_replies_approved', 'ai_replies_modified',
+                    'ai_replies_rejected', 'manual_replies', 'avg_review_time',
+                ]
             )
-        
+            
         logger.info(f"Generated agent performance metrics for {target_date}")
         return {'success': True}
         
@@ -0,0 +1,30 @@
+"""
+Analytics helpers
+"""
+from datetime import datetime, time, timedelta
+from django.db import connection
+from django.utils import timezone
+
+
+def day_range(day):
+    """
+    Return the [start, end) datetimes covering a calendar day in the current timezone.
+    
+    Filtering on received_at__gte/__lt instead of received_at__date lets the
+    database use the timestamp indexes directly rather than wrapping the column
+    in a date conversion.
+    """
+    start = timezone.make_aware(datetime.combine(day, time.min))
+    return start, start + timedelta(days=1)
+
+
+def try_advisory_lock(key):
+    """
+    Try to take a transaction-scoped PostgreSQL advisory lock for the given key.
+    
+    Must be called inside transaction.atomic(); the lock is released on commit
+    or rollback. Returns False immediately if another transaction holds it.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT pg_try_advisory_xact_lock(hashtext(%s))', [key])
+        return cursor.fetchone()[0]
\ No newline at end of file
@@ -5,15 +5,17 @@ from rest_framework import viewsets, status
 from rest_framework.decorators import action
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated
-from django.db.models import Avg, Count, Sum
+from django.db.models import Count, Sum, Max, F, Q, ExpressionWrapper, FloatField
+from django.db.models.functions import Coalesce
 from django.utils import timezone
 from datetime import timedelta
 
 from apps.analytics.models import DailyMetrics, CategoryMetrics, AgentPerformance
+from apps.analytics.utils import day_range
 from apps.analytics.serializers import (
     DailyMetricsSerializer, CategoryMetricsSerializer, AgentPerformanceSerializer
 )
-from apps.emails.models import Email, EmailReply
+from apps.emails.models import Email
 
 
 class AnalyticsViewSet(viewsets.ViewSet):
@@ -29,58 +31,89 @@ class AnalyticsViewSet(viewsets.ViewSet):
         days = int(request.query_params.get('days', 7))
         end_date = timezone.now().date()
         start_date = end_date - timedelta(days=days)
+        window_start, _ = day_range(start_date)
         
-        # Email stats
-        emails = Email.objects.filter(received_at__date__gte=start_date)
+        # Every day, including today's hourly-refreshed partial row, is read
+        # from the pre-aggregated daily metrics
+        metrics = DailyMetrics.objects.filter(date__gte=start_date)
+        totals = metrics.aggregate(
+            total_emails=Coalesce(Sum('total_emails_received'), 0),
+            replied=Coalesce(Sum('total_emails_replied'), 0),
+            total_suggestions=Coalesce(Sum('ai_suggested_replies'), 0),
+            approved=Coalesce(Sum('ai_approved_replies'), 0),
+            modified=Coalesce(Sum('ai_modified_replies'), 0),
+            rejected=Coalesce(Sum('ai_rejected_replies'), 0),
+            # Each day's average weighted by the emails it was taken over
+            response_hours=Sum(
+                ExpressionWrapper(
+                    F('avg_response_time') * F('response_time_count'),
+                    output_field=FloatField()
+                ),
+                filter=Q(avg_response_time__isnull=False)
+            ),
+            response_count=Sum(
+                'response_time_count',
+                filter=Q(avg_response_time__isnull=False)
+            ),
+            last_refreshed_at=Max('updated_at'),
+            partial_days=Count('id', filter=Q(is_partial=True)),
+        )
+        
+        # Open states are a small slice of the table, served by the status index
+        open_counts = dict(
+            Email.objects.filter(
+                received_at__gte=window_start,
+                status__in=['new', 'processing', 'escalated']
+            ).values_list('status').annotate(count=Count('id'))
+        )
+        
+        average_hours = None
+        if totals['response_count']:
+            average_hours = totals['response_hours'] / totals['response_count']
         
         stats = {
             'overview': {
-                'total_emails': emails.count(),
-                'new': emails.filter(status='new').count(),
-                'processing': emails.filter(status='processing').count(),
-                'replied': emails.filter(status='replied').count(),
-                'escalated': emails.filter(status='escalated').count(),
+                'total_emails': totals['total_emails'],
+                'new': open_counts.get('new', 0),
+                'processing': open_counts.get('processing', 0),
+                'replied': totals['replied'],
+                'escalated': open_counts.get('escalated', 0),
             },
             'ai_performance': {
-                'total_suggestions': EmailReply.objects.filter(
-                    created_at__date__gte=start_date,
-                    source='ai'
-                ).count(),
-                'approved': EmailReply.objects.filter(
-                    created_at__date__gte=start_date,
-                    source='ai',
-                    status='approved'
-                ).count(),
-                'modified': EmailReply.objects.filter(
-                    created_at__date__gte=start_date,
-                    source='ai_modified'
-                ).count(),
-                'rejected': EmailReply.objects.filter(
-                    created_at__date__gte=start_date,
-                    source='ai',
-                    status='rejected'
-                ).count(),
+                'total_suggestions': totals['total_suggestions'],
+                'approved': totals['approved'],
+                'modified': totals['modified'],
+                'rejected': totals['rejected'],
             },
             'response_times': {
-                'average_hours': emails.exclude(
-                    replied_at__isnull=True
-                ).aggregate(
-                    avg_time=Avg('replied_at') - Avg('received_at')
-                )
+                'average_hours': average_hours
             },
             'categories': list(
-                emails.values('category__name').annotate(
-                    count=Count('id')
+                CategoryMetrics.objects.filter(
+                    date__gte=start_date
+                ).values('category__name').annotate(
+                    count=Sum('email_count')
                 ).order_by('-count')
             ),
-            'daily_trend': list(
-                DailyMetrics.objects.filter(
-                    date__gte=start_date
-                ).order_by('date').values(
+            'freshness': {
+                'last_refreshed_at': totals['last_refreshed_at'],
+                'includes_partial_day': totals['partial_days'] > 0,
+            },
+            'daily_trend': [
+                {
+                    'date': date,
+                    'total_emails_received': received,
+                    'total_emails_replied': replied,
+                    'ai_approved_replies': approved,
+                    'automation_rate': automation_rate,
+                }
+                for date, received, replied, approved, automation_rate in metrics.order_by(
+                    'date'
+                ).values_list(
                     'date', 'total_emails_received', 'total_emails_replied',
                     'ai_approved_replies', 'automation_rate'
                 )
-            )
+            ]
         }
         
         return Response(stats)
@@ -96,18 +129,43 @@ class AnalyticsViewSet(viewsets.ViewSet):
         
         total_savings = metrics.aggregate(
             total_hours=Sum('estimated_time_saved_hours'),
-            total_cost=Sum('estimated_cost_saved')
+            total_cost_cents=Sum('estimated_cost_saved_cents')
         )
         
         return Response({
             'period_days': days,
             'total_hours_saved': total_savings['total_hours'] or 0,
-            'total_cost_saved': total_savings['total_cost'] or 0,
+            'total_cost_saved': (total_savings['total_cost_cents'] or 0) / 100,
             'average_per_day': (total_savings['total_hours'] or 0) / days,
         })
 
 
-class DailyMetricsViewSet(viewsets.ReadOnlyModelViewSet):
+class PageAnnotatedListMixin:
+    """
+    List mixin that applies expensive queryset additions to the current page only
+    
+    Pagination counts the plain get_queryset(); get_queryset_annotations() is
+    applied afterwards to the primary keys on the page, so joins and annotations
+    never reach the COUNT(*) query.
+    """
+    
+    def get_queryset_annotations(self, queryset):
+        return queryset
+    
+    def list(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset())
+        page = self.paginate_queryset(queryset.values_list('pk', flat=True))
+        
+        if page is None:
+            serializer = self.get_serializer(self.get_queryset_annotations(queryset), many=True)
+            return Response(serializer.data)
+        
+        objects = self.get_queryset_annotations(queryset).in_bulk(page)
+        serializer = self.get_serializer([objects[pk] for pk in page], many=True)
+        return self.get_paginated_response(serializer.data)
+
+
+class DailyMetricsViewSet(PageAnnotatedListMixin, viewsets.ReadOnlyModelViewSet):
     """ViewSet for daily metrics"""
     permission_classes = [IsAuthenticated]
     queryset = DailyMetrics.objects.all()
@@ -115,17 +173,23 @@ class DailyMetricsViewSet(viewsets.ReadOnlyModelViewSet):
     ordering = ['-date']
 
 
-class CategoryMetricsViewSet(viewsets.ReadOnlyModelViewSet):
+class CategoryMetricsViewSet(PageAnnotatedListMixin, viewsets.ReadOnlyModelViewSet):
     """ViewSet for category metrics"""
     permission_classes = [IsAuthenticated]
     queryset = CategoryMetrics.objects.all()
     serializer_class = CategoryMetricsSerializer
     ordering = ['-date']
+    
+    def get_queryset_annotations(self, queryset):
+        return queryset.select_related('category')
 
 
-class AgentPerformanceViewSet(viewsets.ReadOnlyModelViewSet):
+class AgentPerformanceViewSet(PageAnnotatedListMixin, viewsets.ReadOnlyModelViewSet):
     """ViewSet for agent performance"""
     permission_classes = [IsAuthenticated]
     queryset = AgentPerformance.objects.all()
     serializer_class = AgentPerformanceSerializer
-    ordering = ['-date']
\ No newline at end of file
+    ordering = ['-date']
+    
+    def get_queryset_annotations(self, queryset):
+        return queryset.select_related('agent')
\ No newline at end of file
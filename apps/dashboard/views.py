@@ -5,11 +5,14 @@ from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
 from django.utils import timezone
-from django.db.models import Count, Q
+from django.contrib.postgres.search import SearchQuery, SearchRank
+from django.db.models import Count, F, Sum
+from django.db.models.functions import Coalesce
 from datetime import timedelta
 
-from apps.emails.models import Email, EmailReply, EmailCategory
-from apps.emails.services.email_sender import EmailSenderService
+from apps.emails.cache import get_categories
+from apps.emails.models import Email, EmailReply, EMAIL_SEARCH_VECTOR, EMAIL_DETAIL_ONLY_FIELDS
+from apps.emails.services.email_sender import get_sender
 from apps.analytics.models import DailyMetrics
 
 
@@ -27,15 +30,18 @@ def dashboard_home(request):
     escalated = Email.objects.filter(status='escalated').count()
     
     # Recent metrics
-    recent_metrics = DailyMetrics.objects.filter(date__gte=week_ago).order_by('-date')[:7]
+    week_metrics = DailyMetrics.objects.filter(date__gte=week_ago)
+    recent_metrics = week_metrics.order_by('-date').only(
+        'date', 'total_emails_received', 'ai_approved_replies'
+    )[:7]
     
     # Calculate totals
-    week_totals = {
-        'emails_received': sum(m.total_emails_received for m in recent_metrics),
-        'emails_replied': sum(m.total_emails_replied for m in recent_metrics),
-        'ai_approved': sum(m.ai_approved_replies for m in recent_metrics),
-        'time_saved': sum(m.estimated_time_saved_hours for m in recent_metrics),
-    }
+    week_totals = week_metrics.aggregate(
+        emails_received=Coalesce(Sum('total_emails_received'), 0),
+        emails_replied=Coalesce(Sum('total_emails_replied'), 0),
+        ai_approved=Coalesce(Sum('ai_approved_replies'), 0),
+        time_saved=Coalesce(Sum('estimated_time_saved_hours'), 0.0),
+    )
     
     # Automation rate
     if week_totals['emails_received'] > 0:
@@ -65,7 +71,9 @@ def inbox(request):
     search_query = request.GET.get('q', '')
     
     # Base queryset
-    emails = Email.objects.select_related('category', 'assigned_to').order_by('-received_at')
+    emails = Email.objects.select_related('category', 'assigned_to').defer(
+        *EMAIL_DETAIL_ONLY_FIELDS
+    ).order_by('-received_at')
     
     # Apply filters
     if status_filter:
@@ -73,14 +81,18 @@ def inbox(request):
     if category_filter:
         emails = emails.filter(category__name=category_filter)
     if search_query:
-        emails = emails.filter(
-            Q(from_email__icontains=search_query) |
-            Q(subject__icontains=search_query) |
-            Q(body__icontains=search_query)
-        )
+        # Full-text match served by the email_search_gin index
+        query = SearchQuery(search_query, config='english', search_type='websearch')
+        emails = emails.annotate(
+            search=EMAIL_SEARCH_VECTOR
+        ).filter(
+            search=query
+        ).annotate(
+            rank=SearchRank(F('search'), query)
+        ).order_by('-rank', '-received_at')
     
     # Get categories for filter dropdown
-    categories = EmailCategory.objects.all()
+    categories = get_categories()
     
     # Pagination
     from django.core.paginator import Paginator
@@ -141,7 +153,7 @@ def approve_reply(request, reply_id):
     # Send email if requested
     if request.POST.get('send_now') == 'true':
         try:
-            sender = EmailSenderService()
+            sender = get_sender()
             sender.send_reply(reply.email, reply)
             messages.success(request, 'Reply approved and sent successfully!')
         except Exception as e:
@@ -179,19 +191,22 @@ def analytics(request):
     start_date = end_date - timedelta(days=days)
     
     # Get metrics
-    daily_metrics = DailyMetrics.objects.filter(
-        date__gte=start_date
-    ).order_by('date')
+    metrics = DailyMetrics.objects.filter(date__gte=start_date)
+    daily_metrics = metrics.order_by('date').only(
+        'date', 'total_emails_received', 'total_emails_replied',
+        'ai_approved_replies', 'estimated_time_saved_hours'
+    )
     
     # Calculate totals
-    totals = {
-        'emails_received': sum(m.total_emails_received for m in daily_metrics),
-        'emails_replied': sum(m.total_emails_replied for m in daily_metrics),
-        'ai_suggestions': sum(m.ai_suggested_replies for m in daily_metrics),
-        'ai_approved': sum(m.ai_approved_replies for m in daily_metrics),
-        'time_saved': sum(m.estimated_time_saved_hours for m in daily_metrics),
-        'cost_saved': sum(float(m.estimated_cost_saved) for m in daily_metrics),
-    }
+    totals = metrics.aggregate(
+        emails_received=Coalesce(Sum('total_emails_received'), 0),
+        emails_replied=Coalesce(Sum('total_emails_replied'), 0),
+        ai_suggestions=Coalesce(Sum('ai_suggested_replies'), 0),
+        ai_approved=Coalesce(Sum('ai_approved_replies'), 0),
+        time_saved=Coalesce(Sum('estimated_time_saved_hours'), 0.0),
+        cost_saved_cents=Coalesce(Sum('estimated_cost_saved_cents'), 0),
+    )
+    totals['cost_saved'] = totals.pop('cost_saved_cents') / 100
     
     # Calculate rates
     if totals['ai_suggestions'] > 0:
@@ -3,4 +3,7 @@ from django.apps import AppConfig
 
 class EmailsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
-    name = 'emails'
+    name = 'apps.emails'
+
+    def ready(self):
+        from apps.emails import signals  # noqa: F401
@@ -0,0 +1,95 @@
+"""
+Cached lookups for near-static email configuration
+"""
+import hashlib
+import time
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from apps.emails.models import EmailCategory
+
+CATEGORIES_CACHE_KEY = 'email_categories_v1'
+CATEGORIES_CACHE_TIMEOUT = 60 * 60  # 1 hour
+
+# Knowledge base search results; every key embeds the current version, so
+# bumping it on an article change orphans all cached searches at once
+KB_SEARCH_VERSION_KEY = 'kb_search_version'
+KB_SEARCH_CACHE_TIMEOUT = 5 * 60  # 5 minutes
+
+ADMIN_EMAILS_CACHE_KEY = 'escalation_admin_emails_v1'
+ADMIN_EMAILS_CACHE_TIMEOUT = 5 * 60  # 5 minutes
+
+# Per-process copy for the processing hot path; other processes pick up
+# category changes once their copy expires
+LOCAL_CATEGORY_TIMEOUT = 10 * 60  # 10 minutes
+_local_categories = {'expires_at': 0.0, 'by_name': {}}
+
+
+def get_categories():
+    """Return all email categories, cached until a category changes"""
+    return cache.get_or_set(
+        CATEGORIES_CACHE_KEY,
+        lambda: list(EmailCategory.objects.all()),
+        CATEGORIES_CACHE_TIMEOUT
+    )
+
+
+def get_category_by_name(name):
+    """
+    Return the category with this name, or None
+    
+    Served from a per-process dict rebuilt from get_categories() at most every
+    LOCAL_CATEGORY_TIMEOUT seconds, so bursts of emails need no cache round-trip.
+    """
+    now = time.monotonic()
+    if now >= _local_categories['expires_at']:
+        _local_categories['by_name'] = {category.name: category for category in get_categories()}
+        _local_categories['expires_at'] = now + LOCAL_CATEGORY_TIMEOUT
+    return _local_categories['by_name'].get(name)
+
+
+def get_category_keywords():
+    """Return (name, keywords) pairs for every category, as offered to the classifier"""
+    return tuple(
+        (category.name, tuple(category.keywords or ()))
+        for category in get_categories()
+    )
+
+
+def invalidate_category_cache():
+    """Drop cached category data after a category is saved or deleted"""
+    cache.delete(CATEGORIES_CACHE_KEY)
+    _local_categories['expires_at'] = 0.0
+
+
+def get_admin_emails():
+    """Return the addresses of active staff users, who receive escalation notifications"""
+    return cache.get_or_set(
+        ADMIN_EMAILS_CACHE_KEY,
+        lambda: list(
+            User.objects.filter(is_staff=True, is_active=True)
+            .exclude(email='')
+            .values_list('email', flat=True)
+        ),
+        ADMIN_EMAILS_CACHE_TIMEOUT
+    )
+
+
+def invalidate_admin_emails_cache():
+    """Drop the cached admin addresses after a user is saved or deleted"""
+    cache.delete(ADMIN_EMAILS_CACHE_KEY)
+
+
+def get_kb_search_results(params: str, compute):
+    """Return cached results for a knowledge base search, computing them on a miss"""
+    version = cache.get_or_set(KB_SEARCH_VERSION_KEY, 1, None)
+    digest = hashlib.md5(params.encode()).hexdigest()
+    return cache.get_or_set(f'kb_search_v1:{version}:{digest}', compute, KB_SEARCH_CACHE_TIMEOUT)
+
+
+def invalidate_kb_search_cache():
+    """Drop cached knowledge base searches after an article is saved or deleted"""
+    try:
+        cache.incr(KB_SEARCH_VERSION_KEY)
+    except ValueError:
+        # No version yet, so nothing is cached
+        pass
@@ -1,12 +1,71 @@
 """
 Email models for the support system
 """
+from datetime import timedelta
 from django.db import models
+from django.db.models import (
+    BooleanField, Case, DurationField, ExpressionWrapper, F, IntegerField, Q, Value, When
+)
+from django.db.models.functions import Coalesce, Extract, Now
 from django.contrib.auth.models import User
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVector
 from django.utils import timezone
 from django.core.validators import MinValueValidator, MaxValueValidator
 
 
+# Full-text document for inbox search; queries must use this exact expression
+# for PostgreSQL to match it against the email_search_gin index
+EMAIL_SEARCH_VECTOR = SearchVector('subject', 'body', 'from_email', config='english')
+
+# Knowledge base document, titles weighted above content; indexed by kb_search_gin
+KB_SEARCH_VECTOR = (
+    SearchVector('title', weight='A', config='english')
+    + SearchVector('content', weight='B', config='english')
+)
+
+# Wide columns only detail views read; list querysets defer them so their
+# TOASTed values are never fetched
+EMAIL_DETAIL_ONLY_FIELDS = ('body_html', 'ai_extracted_info', 'attachments_data')
+
+# Columns EmailListSerializer reads, for .only() on the list endpoint; the
+# category and assigned_to FK columns stay so related rows still load
+EMAIL_LIST_FIELDS = (
+    'id', 'message_id', 'from_email', 'from_name', 'subject',
+    'category', 'category__name', 'status', 'priority', 'ai_sentiment',
+    'requires_escalation', 'assigned_to', 'received_at', 'replied_at',
+    'response_time_seconds', 'has_attachments', 'created_at',
+)
+
+
+# SQL form of Email.get_response_time() in seconds; rows replied before
+# response_time_seconds was stored fall back to replied_at - received_at
+EMAIL_RESPONSE_SECONDS_EXPRESSION = Coalesce(
+    F('response_time_seconds'),
+    Extract(
+        ExpressionWrapper(F('replied_at') - F('received_at'), output_field=DurationField()),
+        'epoch'
+    ),
+    output_field=IntegerField()
+)
+
+
+# SQL form of Email.is_overdue(): open, categorised with an SLA, and older than it
+EMAIL_OVERDUE_EXPRESSION = Case(
+    When(
+        ~Q(status__in=['replied', 'closed'])
+        & Q(category__sla_hours__gt=0)
+        & Q(received_at__lt=Now() - ExpressionWrapper(
+            F('category__sla_hours') * timedelta(hours=1),
+            output_field=DurationField()
+        )),
+        then=Value(True)
+    ),
+    default=Value(False),
+    output_field=BooleanField()
+)
+
+
 class EmailCategory(models.Model):
     """Categories for email classification"""
     
@@ -59,6 +118,10 @@ class KnowledgeBase(models.Model):
     class Meta:
         verbose_name_plural = "Knowledge Base"
         ordering = ['-use_count', '-created_at']
+        indexes = [
+            GinIndex(KB_SEARCH_VECTOR, name='kb_search_gin'),
+            GinIndex(fields=['keywords'], name='kb_keywords_gin'),
+        ]
     
     def __str__(self):
         return self.title
@@ -134,6 +197,8 @@ class Email(models.Model):
     processed_at = models.DateTimeField(null=True, blank=True)
     replied_at = models.DateTimeField(null=True, blank=True)
     closed_at = models.DateTimeField(null=True, blank=True)
+    # Seconds from received_at to replied_at, stored when the reply is sent
+    response_time_seconds = models.PositiveIntegerField(null=True, blank=True, db_index=True)
     
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
@@ -153,6 +218,21 @@ class Email(models.Model):
             models.Index(fields=['status']),
             models.Index(fields=['from_email']),
             models.Index(fields=['category']),
+            # Analytics hot paths: daily windows split by status / category
+            models.Index(fields=['received_at', 'status']),
+            models.Index(fields=['received_at', 'category']),
+            models.Index(
+                fields=['received_at'],
+                condition=models.Q(requires_escalation=True),
+                name='email_escalation_partial'
+            ),
+            GinIndex(EMAIL_SEARCH_VECTOR, name='email_search_gin'),
+            # Open-queue and SLA sweeps: status IN (...) AND received_at < X
+            models.Index(fields=['status', 'received_at']),
+            models.Index(fields=['category', 'status', 'received_at']),
+            # stats breakdowns under a ?status filter: GROUP BY category / priority
+            models.Index(fields=['status', 'category']),
+            models.Index(fields=['status', 'priority']),
         ]
     
     def __str__(self):
@@ -160,6 +240,8 @@ class Email(models.Model):
     
     def get_response_time(self):
         """Calculate response time in hours"""
+        if self.response_time_seconds is not None:
+            return self.response_time_seconds / 3600
         if self.replied_at and self.received_at:
             delta = self.replied_at - self.received_at
             return delta.total_seconds() / 3600
@@ -170,7 +252,9 @@ class Email(models.Model):
         if self.status in ['replied', 'closed']:
             return False
         
-        if self.category and self.category.sla_hours:
+        # category_id avoids a lookup for uncategorised emails; callers listing
+        # emails should select_related('category')
+        if self.category_id and self.category.sla_hours:
             sla_deadline = self.received_at + timezone.timedelta(hours=self.category.sla_hours)
             return timezone.now() > sla_deadline
         return False
@@ -238,6 +322,10 @@ class EmailReply(models.Model):
     class Meta:
         verbose_name_plural = "Email Replies"
         ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['created_at', 'source', 'status']),
+            models.Index(fields=['email', 'status']),
+        ]
     
     def __str__(self):
         return f"Reply to: {self.email.subject[:50]}"
@@ -260,6 +348,13 @@ class EmailProcessingLog(models.Model):
     
     class Meta:
         ordering = ['created_at']
+        indexes = [
+            models.Index(fields=['email', 'created_at']),
+        ]
     
     def __str__(self):
-        return f"{self.email.message_id} - {self.step} - {self.status}"
\ No newline at end of file
+        return f"{self.email.message_id} - {self.step} - {self.status}"
+
+
+# Category display names, looked up once instead of per get_name_display() call
+CATEGORY_DISPLAY_MAP = dict(EmailCategory.CATEGORY_CHOICES)
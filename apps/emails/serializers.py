@@ -5,10 +5,19 @@ from rest_framework import serializers
 from django.contrib.auth.models import User
 from apps.emails.models import (
     Email, EmailReply, EmailCategory, 
-    KnowledgeBase, EmailProcessingLog
+    KnowledgeBase, EmailProcessingLog, CATEGORY_DISPLAY_MAP
 )
 
 
+class CategoryNameMixin:
+    """Adds get_category_name for a category_name SerializerMethodField"""
+    
+    def get_category_name(self, obj):
+        if not obj.category_id:
+            return None
+        return CATEGORY_DISPLAY_MAP.get(obj.category.name, obj.category.name)
+
+
 class UserSerializer(serializers.ModelSerializer):
     """Simple user serializer"""
     
@@ -25,10 +34,10 @@ class EmailCategorySerializer(serializers.ModelSerializer):
         fields = '__all__'
 
 
-class KnowledgeBaseSerializer(serializers.ModelSerializer):
+class KnowledgeBaseSerializer(CategoryNameMixin, serializers.ModelSerializer):
     """Knowledge base serializer"""
     
-    category_name = serializers.CharField(source='category.get_name_display', read_only=True)
+    category_name = serializers.SerializerMethodField()
     created_by_username = serializers.CharField(source='created_by.username', read_only=True)
     
     class Meta:
@@ -53,7 +62,7 @@ class EmailReplySerializer(serializers.ModelSerializer):
     
     created_by_name = serializers.CharField(source='created_by.get_full_name', read_only=True)
     reviewed_by_name = serializers.CharField(source='reviewed_by.get_full_name', read_only=True)
-    knowledge_articles = KnowledgeBaseSerializer(many=True, read_only=True)
+    knowledge_base_articles = serializers.SlugRelatedField(many=True, read_only=True, slug_field='title')
     
     class Meta:
         model = EmailReply
@@ -61,19 +70,35 @@ class EmailReplySerializer(serializers.ModelSerializer):
             'id', 'email', 'body', 'source', 'status', 'ai_confidence',
             'created_by', 'created_by_name', 'reviewed_by', 'reviewed_by_name',
             'review_notes', 'reviewed_at', 'sent_at', 'created_at',
-            'updated_at', 'knowledge_articles'
+            'updated_at', 'knowledge_base_articles'
         ]
         read_only_fields = ['created_at', 'updated_at', 'sent_at']
 
 
-class EmailListSerializer(serializers.ModelSerializer):
+class EmailReplyListSerializer(EmailReplySerializer):
+    """Email reply serializer fed article titles by the list query"""
+    
+    # Annotated by the list queryset (ArrayAgg over the article titles)
+    knowledge_base_articles = serializers.ListField(
+        source='article_titles', child=serializers.CharField(), read_only=True
+    )
+
+
+class EmailReplyDetailSerializer(EmailReplySerializer):
+    """Email reply serializer with the full knowledge base articles"""
+    
+    knowledge_base_articles = KnowledgeBaseSerializer(many=True, read_only=True)
+
+
+class EmailListSerializer(CategoryNameMixin, serializers.ModelSerializer):
     """Serializer for email list view"""
     
-    category_name = serializers.CharField(source='category.get_name_display', read_only=True)
+    category_name = serializers.SerializerMethodField()
     assigned_to_name = serializers.CharField(source='assigned_to.get_full_name', read_only=True)
-    replies_count = serializers.IntegerField(source='replies.count', read_only=True)
+    replies_count = serializers.IntegerField(read_only=True)
     response_time = serializers.SerializerMethodField()
-    is_overdue = serializers.BooleanField(read_only=True)
+    # Annotated by the list queryset (EMAIL_OVERDUE_EXPRESSION)
+    is_overdue = serializers.BooleanField(source='overdue', read_only=True)
     
     class Meta:
         model = Email
@@ -91,10 +116,10 @@ class EmailListSerializer(serializers.ModelSerializer):
         return obj.get_response_time()
 
 
-class EmailDetailSerializer(serializers.ModelSerializer):
+class EmailDetailSerializer(CategoryNameMixin, serializers.ModelSerializer):
     """Detailed email serializer"""
     
-    category_name = serializers.CharField(source='category.get_name_display', read_only=True)
+    category_name = serializers.SerializerMethodField()
     assigned_to_name = serializers.CharField(source='assigned_to.get_full_name', read_only=True)
     replies = EmailReplySerializer(many=True, read_only=True)
     processing_logs = EmailProcessingLogSerializer(many=True, read_only=True)
@@ -2,95 +2,49 @@
 Claude AI service for email classification and reply generation
 """
 import os
-import json
+import asyncio
 import re
 import logging
 import anthropic
+import orjson
+from collections import Counter
+from functools import lru_cache
 from typing import Dict, List, Tuple, Optional
 from django.conf import settings
-from apps.emails.models import EmailCategory, KnowledgeBase
+from apps.emails.cache import get_category_keywords
+from apps.emails.models import KnowledgeBase
 
 logger = logging.getLogger(__name__)
 
+# Every sensitive data pattern in one alternation so masking is a single pass;
+# the group name decides the token prefix
+SENSITIVE_DATA_RE = re.compile(
+    r'(?P<CARD>\b\d{4}[\s-]?\d{4}[\s-]?\d{4}[\s-]?\d{4}\b)'
+    r'|(?P<SSN>\b\d{3}-\d{2}-\d{4}\b)'
+    r'|(?i:password|pwd|pass)[:\s]+(?P<PASSWORD>\S+)'
+)
 
-class ClaudeEmailAgent:
-    """
-    AI agent for processing support emails using Claude
-    """
-    
-    def __init__(self):
-        self.client = anthropic.Anthropic(
-            api_key=settings.ANTHROPIC_API_KEY
-        )
-        self.model = "claude-sonnet-4-5-20250929"
-    
-    def mask_sensitive_data(self, text: str) -> Tuple[str, Dict]:
-        """
-        Mask sensitive information in email text
-        Returns: (masked_text, mapping_dict)
-        """
-        mapping = {}
-        masked_text = text
-        
-        # Mask credit card numbers
-        cc_pattern = r'\b\d{4}[\s-]?\d{4}[\s-]?\d{4}[\s-]?\d{4}\b'
-        for match in re.finditer(cc_pattern, text):
-            masked = f"[CARD_{len(mapping)}]"
-            mapping[masked] = match.group()
-            masked_text = masked_text.replace(match.group(), masked)
-        
-        # Mask SSN
-        ssn_pattern = r'\b\d{3}-\d{2}-\d{4}\b'
-        for match in re.finditer(ssn_pattern, text):
-            masked = f"[SSN_{len(mapping)}]"
-            mapping[masked] = match.group()
-            masked_text = masked_text.replace(match.group(), masked)
-        
-        # Mask passwords (common patterns)
-        password_patterns = [
-            r'password[:\s]+(\S+)',
-            r'pwd[:\s]+(\S+)',
-            r'pass[:\s]+(\S+)',
-        ]
-        for pattern in password_patterns:
-            for match in re.finditer(pattern, text, re.IGNORECASE):
-                if len(match.groups()) > 0:
-                    password = match.group(1)
-                    masked = f"[PASSWORD_{len(mapping)}]"
-                    mapping[masked] = password
-                    masked_text = masked_text.replace(password, masked)
-        
-        return masked_text, mapping
-    
-    def unmask_sensitive_data(self, text: str, mapping: Dict) -> str:
-        """Restore masked data"""
-        result = text
-        for masked, original in mapping.items():
-            result = result.replace(masked, original)
-        return result
-    
-    def classify_email(self, subject: str, body: str) -> Dict:
-        """
-        Classify email into categories and extract key information
-        
-        Returns: {
-            'category': str,
-            'confidence': float,
-            'priority': str,
-            'sentiment': str,
-            'requires_escalation': bool,
-            'escalation_reason': str,
-            'extracted_info': dict
-        }
-        """
-        # Mask sensitive data
-        masked_body, _ = self.mask_sensitive_data(body)
-        
-        # Get categories
-        categories = list(EmailCategory.objects.values_list('name', flat=True))
-        categories_str = ", ".join([cat for cat in categories])
-        
-        system_prompt = f"""You are an expert email classification system for customer support.
+# Tokens produced by mask_sensitive_data, e.g. [CARD_0]
+MASKED_TOKEN_RE = re.compile(r'\[(?:CARD|SSN|PASSWORD)_\d+\]')
+
+# System prompts; only the placeholders change between calls
+
+# Priority and escalation rules shared by the classification and enrichment prompts
+TRIAGE_GUIDELINES = """Priority Guidelines:
+- urgent: System down, payment failed, security issue, angry customer
+- high: Significant impact, time-sensitive, frustrated customer
+- medium: Standard issues, normal concerns
+- low: General questions, minor issues
+
+Escalation Guidelines (requires_escalation = true):
+- Legal threats or demands
+- Requests for refunds over $500
+- Security or privacy concerns
+- Regulatory compliance issues
+- Extremely negative sentiment with threat to leave
+- Complex technical issues beyond standard troubleshooting"""
+
+CLASSIFICATION_SYSTEM_PROMPT = """You are an expert email classification system for customer support.
 
 Your task is to analyze incoming support emails and provide structured classification.
 
@@ -121,95 +75,38 @@ Classification Guidelines:
 - complaint: Dissatisfaction, complaints, negative feedback
 - feature_request: Suggestions, feature requests, improvements
 
-Priority Guidelines:
-- urgent: System down, payment failed, security issue, angry customer
-- high: Significant impact, time-sensitive, frustrated customer
-- medium: Standard issues, normal concerns
-- low: General questions, minor issues
-
-Escalation Guidelines (requires_escalation = true):
-- Legal threats or demands
-- Requests for refunds over $500
-- Security or privacy concerns
-- Regulatory compliance issues
-- Extremely negative sentiment with threat to leave
-- Complex technical issues beyond standard troubleshooting
+""" + TRIAGE_GUIDELINES + """
 
 CRITICAL: Respond ONLY with the JSON object. No other text before or after."""
 
-        user_prompt = f"""Subject: {subject}
+# Used when keywords already decided the category; Claude only triages
+ENRICHMENT_SYSTEM_PROMPT = """You are an expert email triage system for customer support.
 
-Body:
-{masked_body}
+This email has already been categorised as: {category}
 
-Analyze this email and provide classification."""
+Your task is to assess its urgency and extract key information.
 
-        try:
-            response = self.client.messages.create(
-                model=self.model,
-                max_tokens=1500,
-                system=system_prompt,
-                messages=[
-                    {"role": "user", "content": user_prompt}
-                ]
-            )
-            
-            # Extract JSON from response
-            response_text = response.content[0].text.strip()
-            
-            # Remove markdown code blocks if present
-            response_text = response_text.replace('```json\n', '').replace('\n```', '').strip()
-            
-            # Parse JSON
-            result = json.loads(response_text)
-            
-            logger.info(f"Email classified: {result['category']} (confidence: {result['confidence']})")
-            return result
-            
-        except json.JSONDecodeError as e:
-            logger.error(f"Failed to parse Claude JSON response: {e}")
-            logger.error(f"Response text: {response_text}")
-            # Return default classification
-            return {
-                'category': 'general',
-                'confidence': 0.5,
-                'priority': 'medium',
-                'sentiment': 'neutral',
-                'requires_escalation': False,
-                'escalation_reason': '',
-                'extracted_info': {'issue_summary': 'Classification failed'}
-            }
-        except Exception as e:
-            logger.error(f"Error classifying email: {e}")
-            raise
-    
-    def generate_reply(self, 
-                      subject: str, 
-                      body: str, 
-                      category: str,
-                      customer_name: Optional[str] = None,
-                      knowledge_articles: Optional[List[KnowledgeBase]] = None) -> Dict:
-        """
-        Generate reply to email
-        
-        Returns: {
-            'reply': str,
-            'confidence': float,
-            'requires_review': bool,
-            'used_articles': list
-        }
-        """
-        # Mask sensitive data
-        masked_body, mapping = self.mask_sensitive_data(body)
-        
-        # Prepare knowledge base context
-        kb_context = ""
-        if knowledge_articles:
-            kb_context = "\n\nKnowledge Base Articles:\n"
-            for article in knowledge_articles[:5]:  # Limit to top 5
-                kb_context += f"\n--- Article: {article.title} ---\n{article.content}\n"
-        
-        system_prompt = f"""You are a professional customer support agent responding to customer emails.
+You must respond with ONLY valid JSON in this exact format:
+{{
+    "confidence": 0.0 to 1.0 that the email belongs to this category,
+    "priority": "low/medium/high/urgent",
+    "sentiment": "positive/neutral/negative",
+    "requires_escalation": true/false,
+    "escalation_reason": "reason if escalation needed, empty string otherwise",
+    "extracted_info": {{
+        "customer_name": "extracted or empty",
+        "order_id": "extracted or empty",
+        "account_id": "extracted or empty",
+        "issue_summary": "brief summary",
+        "key_points": ["point1", "point2"]
+    }}
+}}
+
+""" + TRIAGE_GUIDELINES + """
+
+CRITICAL: Respond ONLY with the JSON object. No other text before or after."""
+
+REPLY_SYSTEM_PROMPT = """You are a professional customer support agent responding to customer emails.
 
 Category: {category}
 
@@ -253,7 +150,306 @@ Requires Review (true) if:
 - Technical issue without clear solution
 - Negative sentiment with potential churn risk"""
 
-        customer_greeting = f"Dear {customer_name}," if customer_name else "Hello,"
+SENTIMENT_SYSTEM_PROMPT = """Analyze the sentiment and urgency of this customer email.
+
+Respond with ONLY valid JSON:
+{
+    "sentiment": "positive/neutral/negative",
+    "confidence": 0.0 to 1.0,
+    "urgency_level": 1 to 5,
+    "emotion_tags": ["frustrated", "angry", "confused", etc.],
+    "reasoning": "brief explanation"
+}
+
+Urgency Levels:
+1 - No urgency, general question
+2 - Minor issue, can wait
+3 - Moderate issue, needs response soon
+4 - Important issue, time-sensitive
+5 - Critical issue, immediate attention needed"""
+
+
+@lru_cache(maxsize=16)
+def build_classification_prompt(categories: Tuple[str, ...]) -> str:
+    """Classification system prompt for a set of category names"""
+    return CLASSIFICATION_SYSTEM_PROMPT.format(categories_str=", ".join(categories))
+
+
+@lru_cache(maxsize=16)
+def build_enrichment_prompt(category: str) -> str:
+    """Enrichment system prompt for an email whose category is already known"""
+    return ENRICHMENT_SYSTEM_PROMPT.format(category=category)
+
+
+# A category is decided locally when at least this many keyword hits point to
+# it and it holds this share of all hits
+KEYWORD_MIN_HITS = 2
+KEYWORD_MIN_SHARE = 0.75
+# Claude only enriches keyword-classified emails, so it needs fewer tokens
+KEYWORD_MATCH_MAX_TOKENS = 400
+
+
+@lru_cache(maxsize=4)
+def build_keyword_matcher(category_keywords: Tuple[Tuple[str, Tuple[str, ...]], ...]):
+    """
+    Compile every category keyword into one case-insensitive regex
+    
+    Returns (pattern, keyword -> category name); pattern is None when no
+    category has keywords.
+    """
+    lookup = {}
+    for name, keywords in category_keywords:
+        for keyword in keywords:
+            lookup.setdefault(keyword.lower(), name)
+    
+    if not lookup:
+        return None, lookup
+    
+    # Longest first so multi-word keywords win over their prefixes
+    alternation = '|'.join(re.escape(keyword) for keyword in sorted(lookup, key=len, reverse=True))
+    return re.compile(rf'\b(?:{alternation})\b', re.IGNORECASE), lookup
+
+
+def match_keyword_category(text: str, category_keywords) -> Optional[str]:
+    """Category clearly indicated by keywords in the text, if any"""
+    pattern, lookup = build_keyword_matcher(category_keywords)
+    if pattern is None:
+        return None
+    
+    hits = Counter(lookup[match.group().lower()] for match in pattern.finditer(text))
+    if not hits:
+        return None
+    
+    category, count = hits.most_common(1)[0]
+    if count >= KEYWORD_MIN_HITS and count / sum(hits.values()) >= KEYWORD_MIN_SHARE:
+        return category
+    return None
+
+
+def add_greeting(reply: str, customer_name: Optional[str]) -> str:
+    """Prefix a reply with the customer greeting"""
+    customer_greeting = f"Dear {customer_name}," if customer_name else "Hello,"
+    return f"{customer_greeting}\n\n{reply}"
+
+
+class ClaudeEmailAgent:
+    """
+    AI agent for processing support emails using Claude
+    """
+    
+    def __init__(self):
+        self.client = anthropic.Anthropic(
+            api_key=settings.ANTHROPIC_API_KEY
+        )
+        self.model = "claude-sonnet-4-5-20250929"
+    
+    def mask_sensitive_data(self, text: str) -> Tuple[str, Dict]:
+        """
+        Mask sensitive information in email text
+        Returns: (masked_text, mapping_dict)
+        """
+        mapping = {}
+        
+        def replace(match):
+            kind = match.lastgroup
+            masked = f"[{kind}_{len(mapping)}]"
+            mapping[masked] = match.group(kind)
+            # Keep the "password: " prefix, only the value is masked
+            return match.string[match.start():match.start(kind)] + masked
+        
+        masked_text = SENSITIVE_DATA_RE.sub(replace, text)
+        
+        if mapping:
+            # A captured value can appear again without its "password:" prefix;
+            # mask whole-word repeats too, leaving the tokens already inserted alone
+            tokens = {value: masked for masked, value in mapping.items()}
+            values = sorted(tokens, key=len, reverse=True)
+            repeats = re.compile(
+                f"(?P<token>{MASKED_TOKEN_RE.pattern})"
+                f"|(?<!\\w)(?:{'|'.join(map(re.escape, values))})(?!\\w)"
+            )
+            masked_text = repeats.sub(
+                lambda match: match.group() if match.group('token') else tokens[match.group()],
+                masked_text
+            )
+        
+        return masked_text, mapping
+    
+    def unmask_sensitive_data(self, text: str, mapping: Dict) -> str:
+        """Restore masked data"""
+        if not mapping:
+            return text
+        return MASKED_TOKEN_RE.sub(lambda match: mapping.get(match.group(), match.group()), text)
+    
+    def _classification_request(self, subject: str, body: str, category_keywords) -> Tuple[Dict, Optional[str]]:
+        """
+        Build the messages.create() arguments for classifying one email
+        
+        Returns (request, keyword_category). Obvious emails are categorised
+        from keywords; Claude then only fills in priority, sentiment,
+        escalation and extracted info.
+        """
+        keyword_category = match_keyword_category(f"{subject}\n{body}", category_keywords)
+        if keyword_category:
+            system = build_enrichment_prompt(keyword_category)
+            max_tokens = KEYWORD_MATCH_MAX_TOKENS
+        else:
+            system = build_classification_prompt(tuple(name for name, _ in category_keywords))
+            max_tokens = 1500
+        
+        # Mask sensitive data
+        masked_body, _ = self.mask_sensitive_data(body)
+        
+        user_prompt = f"""Subject: {subject}
+
+Body:
+{masked_body}
+
+Analyze this email and provide classification."""
+
+        request = {
+            'model': self.model,
+            'max_tokens': max_tokens,
+            'system': system,
+            'messages': [
+                {"role": "user", "content": user_prompt}
+            ],
+        }
+        return request, keyword_category
+    
+    def _parse_classification(self, response, keyword_category: Optional[str] = None) -> Dict:
+        """Parse a classification response, falling back to a default on bad JSON"""
+        # Extract JSON from response
+        response_text = response.content[0].text.strip()
+        
+        # Remove markdown code blocks if present
+        response_text = response_text.replace('```json\n', '').replace('\n```', '').strip()
+        
+        try:
+            result = orjson.loads(response_text)
+        except orjson.JSONDecodeError as e:
+            logger.error(f"Failed to parse Claude JSON response: {e}")
+            logger.error(f"Response text: {response_text}")
+            # Return default classification
+            return {
+                'category': keyword_category or 'general',
+                'confidence': 0.5,
+                'priority': 'medium',
+                'sentiment': 'neutral',
+                'requires_escalation': False,
+                'escalation_reason': '',
+                'extracted_info': {'issue_summary': 'Classification failed'}
+            }
+        
+        if keyword_category:
+            result['category'] = keyword_category
+        
+        logger.info(f"Email classified: {result['category']} (confidence: {result['confidence']})")
+        return result
+    
+    def classify_email(self, subject: str, body: str) -> Dict:
+        """
+        Classify email into categories and extract key information
+        
+        Returns: {
+            'category': str,
+            'confidence': float,
+            'priority': str,
+            'sentiment': str,
+            'requires_escalation': bool,
+            'escalation_reason': str,
+            'extracted_info': dict
+        }
+        """
+        request, keyword_category = self._classification_request(subject, body, get_category_keywords())
+        
+        try:
+            response = self.client.messages.create(**request)
+            return self._parse_classification(response, keyword_category)
+            
+        except Exception as e:
+            logger.error(f"Error classifying email: {e}")
+            raise
+    
+    async def classify_email_async(self,
+                                   client: anthropic.AsyncAnthropic,
+                                   subject: str,
+                                   body: str,
+                                   category_keywords) -> Dict:
+        """
+        Classify email with an async client
+        
+        Categories are passed in because the ORM cannot be used from the event loop.
+        """
+        request, keyword_category = self._classification_request(subject, body, category_keywords)
+        response = await client.messages.create(**request)
+        return self._parse_classification(response, keyword_category)
+    
+    def classify_emails(self, emails: List[Tuple[str, str]]) -> List[Optional[Dict]]:
+        """
+        Classify a batch of (subject, body) pairs concurrently
+        
+        Returns one result per email, in order; None where the request failed.
+        """
+        category_keywords = get_category_keywords()
+        return self._run_concurrently(
+            self.classify_email_async,
+            [(subject, body, category_keywords) for subject, body in emails],
+            'classifying email'
+        )
+    
+    def _run_concurrently(self, call, items: List[Tuple], action: str) -> List[Optional[Dict]]:
+        """
+        Await call(client, *item) for every item on one event loop
+        
+        At most settings.CLAUDE_MAX_CONCURRENCY requests are in flight at once.
+        Returns one result per item, in order; None where the request failed.
+        """
+        async def run_all():
+            semaphore = asyncio.Semaphore(settings.CLAUDE_MAX_CONCURRENCY)
+            client = anthropic.AsyncAnthropic(api_key=settings.ANTHROPIC_API_KEY)
+            
+            async def run(item):
+                async with semaphore:
+                    return await call(client, *item)
+            
+            try:
+                return await asyncio.gather(
+                    *(run(item) for item in items),
+                    return_exceptions=True
+                )
+            finally:
+                await client.close()
+        
+        if not items:
+            return []
+        
+        results = []
+        for result in asyncio.run(run_all()):
+            if isinstance(result, Exception):
+                logger.error(f"Error {action}: {result}")
+                result = None
+            results.append(result)
+        return results
+    
+    def _reply_request(self,
+                       subject: str,
+                       body: str,
+                       category: str,
+                       knowledge_articles: Optional[List[KnowledgeBase]] = None) -> Tuple[Dict, Dict]:
+        """Build the messages.create() arguments for a reply, plus the masking map"""
+        # Mask sensitive data
+        masked_body, mapping = self.mask_sensitive_data(body)
+        
+        # Prepare knowledge base context
+        kb_context = ""
+        if knowledge_articles:
+            kb_context = "\n\nKnowledge Base Articles:\n" + "".join(
+                f"\n--- Article: {article.title} ---\n{article.content}\n"
+                for article in knowledge_articles[:5]  # Limit to top 5
+            )
+        
+        system_prompt = REPLY_SYSTEM_PROMPT.format(category=category, kb_context=kb_context)
         
         user_prompt = f"""Customer Email:
 Subject: {subject}
@@ -261,38 +457,92 @@ Body: {masked_body}
 
 Generate a professional reply to this customer email."""
 
+        request = {
+            'model': self.model,
+            'max_tokens': 2000,
+            'system': system_prompt,
+            'messages': [
+                {"role": "user", "content": user_prompt}
+            ],
+        }
+        return request, mapping
+    
+    def _parse_reply(self, response, mapping: Dict, customer_name: Optional[str], greet: bool = True) -> Dict:
+        """Turn a reply response into the generate_reply() result"""
+        # Extract JSON
+        response_text = response.content[0].text.strip()
+        response_text = response_text.replace('```json\n', '').replace('\n```', '').strip()
+        
+        result = orjson.loads(response_text)
+        
+        # Unmask any sensitive data (though there shouldn't be any in reply)
+        result['reply'] = self.unmask_sensitive_data(result['reply'], mapping)
+        
+        if greet:
+            result['reply'] = add_greeting(result['reply'], customer_name)
+        
+        logger.info(f"Reply generated with confidence: {result['confidence']}")
+        return result
+    
+    def generate_reply(self, 
+                      subject: str, 
+                      body: str, 
+                      category: str,
+                      customer_name: Optional[str] = None,
+                      knowledge_articles: Optional[List[KnowledgeBase]] = None,
+                      greet: bool = True) -> Dict:
+        """
+        Generate reply to email
+        
+        With greet=False the greeting is left for the caller to add (see
+        add_greeting), e.g. when the customer name is not known yet.
+        
+        Returns: {
+            'reply': str,
+            'confidence': float,
+            'requires_review': bool,
+            'used_articles': list
+        }
+        """
+        request, mapping = self._reply_request(subject, body, category, knowledge_articles)
+        
         try:
-            response = self.client.messages.create(
-                model=self.model,
-                max_tokens=2000,
-                system=system_prompt,
-                messages=[
-                    {"role": "user", "content": user_prompt}
-                ]
-            )
-            
-            # Extract JSON
-            response_text = response.content[0].text.strip()
-            response_text = response_text.replace('```json\n', '').replace('\n```', '').strip()
-            
-            result = json.loads(response_text)
-            
-            # Unmask any sensitive data (though there shouldn't be any in reply)
-            result['reply'] = self.unmask_sensitive_data(result['reply'], mapping)
+            response = self.client.messages.create(**request)
+            return self._parse_reply(response, mapping, customer_name, greet)
             
-            # Add greeting
-            result['reply'] = f"{customer_greeting}\n\n{result['reply']}"
-            
-            logger.info(f"Reply generated with confidence: {result['confidence']}")
-            return result
-            
-        except json.JSONDecodeError as e:
+        except orjson.JSONDecodeError as e:
             logger.error(f"Failed to parse Claude JSON response: {e}")
             raise
         except Exception as e:
             logger.error(f"Error generating reply: {e}")
             raise
     
+    async def generate_reply_async(self,
+                                   client: anthropic.AsyncAnthropic,
+                                   subject: str,
+                                   body: str,
+                                   category: str,
+                                   customer_name: Optional[str] = None,
+                                   knowledge_articles: Optional[List[KnowledgeBase]] = None) -> Dict:
+        """
+        Generate reply with an async client
+        
+        Articles must already be loaded; the ORM cannot be used from the event loop.
+        """
+        request, mapping = self._reply_request(subject, body, category, knowledge_articles)
+        response = await client.messages.create(**request)
+        return self._parse_reply(response, mapping, customer_name)
+    
+    def generate_replies(self, emails: List[Tuple]) -> List[Optional[Dict]]:
+        """
+        Generate replies for a batch concurrently
+        
+        Each item holds generate_reply()'s arguments: (subject, body, category,
+        customer_name, knowledge_articles). Returns one result per item, in
+        order; None where the request failed.
+        """
+        return self._run_concurrently(self.generate_reply_async, emails, 'generating reply')
+    
     def analyze_sentiment(self, text: str) -> Dict:
         """
         Perform detailed sentiment analysis
@@ -304,23 +554,7 @@ Generate a professional reply to this customer email."""
             'emotion_tags': list
         }
         """
-        system_prompt = """Analyze the sentiment and urgency of this customer email.
-
-Respond with ONLY valid JSON:
-{
-    "sentiment": "positive/neutral/negative",
-    "confidence": 0.0 to 1.0,
-    "urgency_level": 1 to 5,
-    "emotion_tags": ["frustrated", "angry", "confused", etc.],
-    "reasoning": "brief explanation"
-}
-
-Urgency Levels:
-1 - No urgency, general question
-2 - Minor issue, can wait
-3 - Moderate issue, needs response soon
-4 - Important issue, time-sensitive
-5 - Critical issue, immediate attention needed"""
+        system_prompt = SENTIMENT_SYSTEM_PROMPT
 
         try:
             response = self.client.messages.create(
@@ -335,7 +569,7 @@ Urgency Levels:
             response_text = response.content[0].text.strip()
             response_text = response_text.replace('```json\n', '').replace('\n```', '').strip()
             
-            return json.loads(response_text)
+            return orjson.loads(response_text)
             
         except Exception as e:
             logger.error(f"Error analyzing sentiment: {e}")
@@ -3,16 +3,288 @@ Email fetcher service using IMAP
 """
 import email
 import logging
+import re
 from email.header import decode_header
-from datetime import datetime
-from typing import List, Dict, Optional
-import imapclient
+from email.message import Message
+from email.parser import BytesHeaderParser
+from email.utils import parseaddr, parsedate_to_datetime
+from html.parser import HTMLParser
+from datetime import datetime, timezone as dt_timezone
+from functools import lru_cache
+from typing import Dict, Iterator, List, Optional, Tuple
 from django.conf import settings
-from django.utils import timezone
+from django.db import DatabaseError, IntegrityError, connection, transaction
 from apps.emails.models import Email
+from apps.emails.services import imap_pool
 
 logger = logging.getLogger(__name__)
 
+# UIDs per FETCH command
+FETCH_CHUNK_SIZE = 100
+
+# Header-only fetch used to skip messages that are already stored; PEEK keeps
+# the \Seen flag untouched
+MESSAGE_ID_FETCH = 'BODY.PEEK[HEADER.FIELDS (MESSAGE-ID)]'
+MESSAGE_ID_RESPONSE = b'BODY[HEADER.FIELDS (MESSAGE-ID)]'
+
+# Single-part bodies in these transfer encodings can be decoded as-is
+PLAIN_TRANSFER_ENCODINGS = frozenset({'', '7bit', '8bit', 'binary'})
+CHARSET_RE = re.compile(r'charset=["\']?([^;"\'\s]+)', re.IGNORECASE)
+
+_header_parser = BytesHeaderParser()
+
+
+def _batched(items: List, size: int) -> Iterator[List]:
+    """Split a list into consecutive chunks of at most size items"""
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+class _HTMLTextExtractor(HTMLParser):
+    """Collects the text content of an HTML document, skipping scripts and styles"""
+    
+    SKIPPED_TAGS = {'script', 'style', 'head', 'title'}
+    
+    def __init__(self):
+        # convert_charrefs decodes &nbsp;, &amp; and every other entity
+        super().__init__(convert_charrefs=True)
+        self.parts = []
+        self.skip_depth = 0
+    
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIPPED_TAGS:
+            self.skip_depth += 1
+    
+    def handle_endtag(self, tag):
+        if tag in self.SKIPPED_TAGS and self.skip_depth:
+            self.skip_depth -= 1
+    
+    def handle_data(self, data):
+        if not self.skip_depth:
+            self.parts.append(data)
+
+
+def html_to_text(html: str) -> str:
+    """Plain text of an HTML body, in one linear tokenizer pass"""
+    parser = _HTMLTextExtractor()
+    parser.feed(html)
+    parser.close()
+    return ''.join(parser.parts).replace('\xa0', ' ')
+
+
+def decode_header_value(header: str) -> str:
+    """Decode an RFC 2047 encoded header"""
+    if not header:
+        return ''
+    
+    return ''.join(
+        part.decode(encoding or 'utf-8', errors='ignore') if isinstance(part, bytes) else str(part)
+        for part, encoding in decode_header(header)
+    )
+
+
+def _decode_all(email_message: Message, names: Tuple[str, ...]) -> Tuple[str, ...]:
+    """Decode several headers of a message in one pass"""
+    return tuple(decode_header_value(email_message.get(name, '')) for name in names)
+
+
+# Threaded support mail repeats the same senders and dates within a batch;
+# the header parsers below are memoized per worker process
+HEADER_PARSE_CACHE_SIZE = 512
+
+
+@lru_cache(maxsize=HEADER_PARSE_CACHE_SIZE)
+def parse_email_address(address_header: str) -> tuple:
+    """
+    Parse email address from header
+    Returns: (email, name)
+    """
+    if not address_header:
+        return '', ''
+    
+    name, email_addr = parseaddr(address_header)
+    
+    return email_addr, name
+
+
+def extract_body(email_message) -> tuple:
+    """
+    Extract plain text and HTML body
+    Returns: (text_body, html_body)
+    """
+    text_body = ''
+    html_body = ''
+    
+    if email_message.is_multipart():
+        for part in email_message.walk():
+            if text_body and html_body:
+                break
+            
+            content_type = part.get_content_type()
+            content_disposition = part.get_content_disposition()
+            
+            # Skip attachments
+            if content_disposition == 'attachment':
+                continue
+            
+            # Only the first plain and first HTML part are kept; decode nothing else
+            wanted_plain = content_type == 'text/plain' and not text_body
+            wanted_html = content_type == 'text/html' and not html_body
+            if not (wanted_plain or wanted_html):
+                continue
+            
+            try:
+                payload = part.get_payload(decode=True)
+                if payload:
+                    charset = part.get_content_charset() or 'utf-8'
+                    decoded_payload = payload.decode(charset, errors='ignore')
+                    
+                    if wanted_plain:
+                        text_body = decoded_payload
+                    else:
+                        html_body = decoded_payload
+            except Exception as e:
+                logger.warning(f"Error extracting body part: {e}")
+    else:
+        # Not multipart
+        payload = email_message.get_payload(decode=True)
+        if payload:
+            charset = email_message.get_content_charset() or 'utf-8'
+            text_body = payload.decode(charset, errors='ignore')
+    
+    # If no text body but has HTML, extract text from HTML
+    if not text_body and html_body:
+        text_body = html_to_text(html_body)
+    
+    return text_body.strip(), html_body.strip()
+
+
+def parse_date(date_str: str) -> datetime:
+    """Parse email date header"""
+    if not date_str:
+        return datetime.now(dt_timezone.utc)
+    
+    return _parse_date_header(str(date_str)) or datetime.now(dt_timezone.utc)
+
+
+@lru_cache(maxsize=HEADER_PARSE_CACHE_SIZE)
+def _parse_date_header(date_str: str) -> Optional[datetime]:
+    try:
+        return parsedate_to_datetime(date_str)
+    except Exception:
+        return None
+
+
+def _attachment_size(part: Message) -> int:
+    """Approximate decoded size from the encoded payload, without decoding it"""
+    payload = part.get_payload()
+    if not isinstance(payload, str):
+        return 0
+    if str(part.get('Content-Transfer-Encoding', '')).strip().lower() == 'base64':
+        return len(payload) * 3 // 4
+    return len(payload.encode('utf-8', 'ignore'))
+
+
+def _parse_single_part(raw_email: bytes) -> Optional[Tuple[Message, str]]:
+    """
+    Headers and text body of a plain single-part message, or None
+    
+    Most support emails are single-part text with no transfer encoding; these
+    skip building and walking a MIME tree. Anything else returns None and goes
+    through the full parser.
+    """
+    head, separator, body = raw_email.partition(b'\r\n\r\n')
+    if not separator:
+        head, _, body = raw_email.partition(b'\n\n')
+    
+    if b'multipart' in head.lower():
+        return None
+    
+    headers = _header_parser.parsebytes(head)
+    transfer_encoding = str(headers.get('Content-Transfer-Encoding', '')).strip().lower()
+    if transfer_encoding not in PLAIN_TRANSFER_ENCODINGS or headers.get_content_disposition() == 'attachment':
+        return None
+    
+    match = CHARSET_RE.search(str(headers.get('Content-Type', '')))
+    charset = match.group(1) if match else 'utf-8'
+    try:
+        text_body = body.decode(charset, errors='ignore')
+    except LookupError:
+        text_body = body.decode('utf-8', errors='ignore')
+    
+    return headers, text_body.strip()
+
+
+def parse_raw_email(raw_email: bytes, received_at: Optional[datetime] = None) -> Dict:
+    """
+    Parse a raw RFC 822 message into Email field values
+    
+    Pure function with no Django access, so it can run in a worker process.
+    received_at is the server's INTERNALDATE; the Date header is only parsed
+    when it is missing.
+    """
+    single_part = _parse_single_part(raw_email)
+    if single_part is not None:
+        email_message, body_text = single_part
+        body_html = ''
+    else:
+        email_message = email.message_from_bytes(raw_email)
+        body_text, body_html = extract_body(email_message)
+    
+    # Extract message ID (already checked against stored emails)
+    message_id = email_message.get('Message-ID', '')
+    
+    # Extract headers
+    subject, from_header, to_header = _decode_all(email_message, ('Subject', 'From', 'To'))
+    
+    # Parse from address
+    from_email, from_name = parse_email_address(from_header)
+    to_email, _ = parse_email_address(to_header)
+    
+    # Check for attachments (a fast-path message never has any)
+    has_attachments = False
+    attachments_data = []
+    
+    for part in email_message.walk() if single_part is None else ():
+        if part.get_content_disposition() == 'attachment':
+            has_attachments = True
+            filename = part.get_filename()
+            if filename:
+                attachments_data.append({
+                    'filename': filename,
+                    'content_type': part.get_content_type(),
+                    'size': _attachment_size(part)
+                })
+    
+    return {
+        'message_id': message_id,
+        'from_email': from_email,
+        'from_name': from_name,
+        'to_email': to_email,
+        'subject': subject,
+        'body': body_text,
+        'body_html': body_html,
+        'received_at': received_at or parse_date(email_message.get('Date')),
+        'has_attachments': has_attachments,
+        'attachments_data': attachments_data,
+        # Thread info
+        'in_reply_to': email_message.get('In-Reply-To', ''),
+        'thread_id': email_message.get('Thread-Index', ''),
+    }
+
+
+def _parse_raw_email_safely(raw_email: bytes, received_at: Optional[datetime]) -> Tuple[Optional[Dict], str]:
+    """parse_raw_email() returning (fields, error) so one bad message can't stop the batch"""
+    try:
+        return parse_raw_email(raw_email, received_at), ''
+    except Exception as e:
+        return None, str(e)
+
+
+def parse_raw_emails(messages: List[Tuple[bytes, Optional[datetime]]]) -> List[Tuple[Optional[Dict], str]]:
+    """Parse a batch of (raw message, INTERNALDATE) pairs into (fields, error) pairs"""
+    return [_parse_raw_email_safely(raw_email, received_at) for raw_email, received_at in messages]
+
 
 class EmailFetcherService:
     """
@@ -25,13 +297,17 @@ class EmailFetcherService:
         self.username = settings.EMAIL_ACCOUNT
         self.password = settings.EMAIL_PASSWORD
     
-    def fetch_new_emails(self, mailbox: str = 'INBOX', limit: int = 50) -> List[Email]:
+    def fetch_new_emails(self,
+                         mailbox: str = 'INBOX',
+                         limit: int = 50,
+                         exclude_thread_ids: Optional[List[str]] = None) -> List[Email]:
         """
         Fetch new unread emails from mailbox
         
         Args:
             mailbox: IMAP mailbox name (default: INBOX)
             limit: Maximum number of emails to fetch
+            exclude_thread_ids: Message IDs whose replies the server should leave out
         
         Returns:
             List of created Email objects
@@ -39,19 +315,16 @@ class EmailFetcherService:
         created_emails = []
         
         try:
-            # Connect to IMAP server
-            logger.info(f"Connecting to IMAP: {self.imap_host}:{self.imap_port}")
-            
-            with imapclient.IMAPClient(self.imap_host, port=self.imap_port, ssl=True) as client:
-                # Login
-                client.login(self.username, self.password)
-                logger.info("IMAP login successful")
-                
+            # Reuse this worker's logged-in connection to the account
+            with imap_pool.connection(self.imap_host, self.imap_port, self.username, self.password) as client:
                 # Select mailbox
                 client.select_folder(mailbox)
                 
                 # Search for unseen messages
-                messages = client.search(['UNSEEN'])
+                criteria = ['UNSEEN']
+                for thread_id in exclude_thread_ids or ():
+                    criteria += ['NOT', 'HEADER', 'In-Reply-To', thread_id]
+                messages = client.search(criteria)
                 logger.info(f"Found {len(messages)} unread messages")
                 
                 # Limit messages
@@ -61,24 +334,31 @@ class EmailFetcherService:
                 if not messages:
                     return created_emails
                 
-                # Fetch messages
-                response = client.fetch(messages, ['RFC822', 'FLAGS', 'INTERNALDATE'])
+                # Download full bodies only for messages not stored yet
+                new_messages = self._filter_new_messages(client, messages)
+                logger.info(f"{len(new_messages)} of {len(messages)} messages are new")
                 
-                for msg_id, data in response.items():
-                    try:
-                        # Parse email
-                        email_obj = self._parse_email(data)
-                        
-                        if email_obj:
-                            created_emails.append(email_obj)
-                            logger.info(f"Created email: {email_obj.subject[:50]}")
-                        
-                        # Mark as seen (optional - comment out if you want to keep as unread)
-                        # client.add_flags(msg_id, [imapclient.SEEN])
-                        
-                    except Exception as e:
-                        logger.error(f"Error parsing message {msg_id}: {e}")
-                        continue
+                raw_messages = [
+                    (msg_id, data[b'RFC822'], data.get(b'INTERNALDATE'))
+                    for msg_id, data in self._fetch_bodies(client, new_messages)
+                ]
+                
+                # Mark as seen (optional - uncomment if messages should not stay unread)
+                # client.add_flags([msg_id for msg_id, _, _ in raw_messages], [b'\\Seen'])
+            
+            # Parse outside the IMAP session; the connection is free for the next poll
+            parsed = parse_raw_emails([(raw, received_at) for _, raw, received_at in raw_messages])
+            
+            candidates = []
+            for (msg_id, _, _), (fields, error) in zip(raw_messages, parsed):
+                if fields is None:
+                    logger.error(f"Error parsing message {msg_id}: {error}")
+                    continue
+                
+                fields['to_email'] = fields['to_email'] or self.username
+                candidates.append(Email(status='new', **fields))
+            
+            created_emails = self._save_emails(candidates)
             
             logger.info(f"Successfully fetched {len(created_emails)} emails")
             return created_emails
@@ -87,163 +367,118 @@ class EmailFetcherService:
             logger.error(f"Error fetching emails: {e}")
             raise
     
-    def _parse_email(self, data: Dict) -> Optional[Email]:
+    def _save_emails(self, candidates: List[Email]) -> List[Email]:
         """
-        Parse raw email data into Email model
+        Insert parsed emails, skipping message IDs that are already stored
+        
+        Returns only the rows this INSERT created. A message another fetch
+        stored first is left to that fetch, so it is never queued twice.
         """
-        try:
-            raw_email = data[b'RFC822']
-            email_message = email.message_from_bytes(raw_email)
-            
-            # Extract message ID
-            message_id = email_message.get('Message-ID', '')
-            
-            # Check if email already exists
-            if Email.objects.filter(message_id=message_id).exists():
-                logger.info(f"Email already exists: {message_id}")
-                return None
-            
-            # Extract headers
-            subject = self._decode_header(email_message.get('Subject', ''))
-            from_header = self._decode_header(email_message.get('From', ''))
-            to_header = self._decode_header(email_message.get('To', ''))
-            date_header = email_message.get('Date')
-            
-            # Parse from address
-            from_email, from_name = self._parse_email_address(from_header)
-            to_email, _ = self._parse_email_address(to_header)
-            
-            # Extract body
-            body_text, body_html = self._extract_body(email_message)
-            
-            # Parse date
-            received_at = self._parse_date(date_header)
-            
-            # Extract thread info
-            in_reply_to = email_message.get('In-Reply-To', '')
-            thread_id = email_message.get('Thread-Index', '')
-            
-            # Check for attachments
-            has_attachments = False
-            attachments_data = []
-            
-            for part in email_message.walk():
-                if part.get_content_disposition() == 'attachment':
-                    has_attachments = True
-                    filename = part.get_filename()
-                    if filename:
-                        attachments_data.append({
-                            'filename': filename,
-                            'content_type': part.get_content_type(),
-                            'size': len(part.get_payload(decode=True) or b'')
-                        })
-            
-            # Create Email object
-            email_obj = Email.objects.create(
-                message_id=message_id,
-                from_email=from_email,
-                from_name=from_name,
-                to_email=to_email or self.username,
-                subject=subject,
-                body=body_text,
-                body_html=body_html,
-                received_at=received_at,
-                status='new',
-                has_attachments=has_attachments,
-                attachments_data=attachments_data,
-                in_reply_to=in_reply_to,
-                thread_id=thread_id,
-            )
-            
-            return email_obj
-            
-        except Exception as e:
-            logger.error(f"Error parsing email: {e}")
-            raise
-    
-    def _decode_header(self, header: str) -> str:
-        """Decode email header"""
-        if not header:
-            return ''
+        if not candidates:
+            return []
         
-        decoded_parts = []
-        for part, encoding in decode_header(header):
-            if isinstance(part, bytes):
-                decoded_parts.append(part.decode(encoding or 'utf-8', errors='ignore'))
-            else:
-                decoded_parts.append(str(part))
+        try:
+            inserted_ids = self._insert_ignoring_conflicts(candidates)
+        except DatabaseError as e:
+            # One bad row fails the whole INSERT; save the rest individually
+            logger.error(f"Bulk insert of fetched emails failed, saving one by one: {e}")
+            created_emails = []
+            for email_obj in candidates:
+                try:
+                    with transaction.atomic():
+                        email_obj.save(force_insert=True)
+                except IntegrityError:
+                    # Already stored by a concurrent fetch
+                    continue
+                except DatabaseError as e:
+                    logger.error(f"Error saving message {email_obj.message_id}: {e}")
+                    continue
+                created_emails.append(email_obj)
+            return created_emails
         
-        return ''.join(decoded_parts)
+        created_emails = []
+        for email_obj in candidates:
+            # pop() so a message listed twice in one batch is only returned once
+            pk = inserted_ids.pop(email_obj.message_id, None)
+            if pk is None:
+                continue
+            email_obj.pk = pk
+            email_obj._state.adding = False
+            created_emails.append(email_obj)
+        return created_emails
     
-    def _parse_email_address(self, address_header: str) -> tuple:
+    def _insert_ignoring_conflicts(self, candidates: List[Email]) -> Dict[str, int]:
         """
-        Parse email address from header
-        Returns: (email, name)
+        INSERT ... ON CONFLICT (message_id) DO NOTHING RETURNING id
+        
+        bulk_create(ignore_conflicts=True) cannot report which rows were
+        inserted, so the statement is built from the model's fields here.
+        Returns {message_id: id} for the inserted rows only.
         """
-        if not address_header:
-            return '', ''
+        quote = connection.ops.quote_name
+        fields = [field for field in Email._meta.concrete_fields if not field.primary_key]
+        pk_column = quote(Email._meta.pk.column)
+        message_id_column = quote(Email._meta.get_field('message_id').column)
         
-        # Use email.utils to parse
-        from email.utils import parseaddr
-        name, email_addr = parseaddr(address_header)
+        params = []
+        for email_obj in candidates:
+            params.extend(
+                field.get_db_prep_save(field.pre_save(email_obj, True), connection)
+                for field in fields
+            )
         
-        return email_addr, name
+        row = f"({', '.join(['%s'] * len(fields))})"
+        sql = (
+            f"INSERT INTO {quote(Email._meta.db_table)} "
+            f"({', '.join(quote(field.column) for field in fields)}) "
+            f"VALUES {', '.join([row] * len(candidates))} "
+            f"ON CONFLICT ({message_id_column}) DO NOTHING "
+            f"RETURNING {pk_column}, {message_id_column}"
+        )
+        
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            return {message_id: pk for pk, message_id in cursor.fetchall()}
     
-    def _extract_body(self, email_message) -> tuple:
-        """
-        Extract plain text and HTML body
-        Returns: (text_body, html_body)
+    def _fetch_message_ids(self, client, uids: List[int]) -> Dict[int, str]:
+        """Fetch only the Message-ID header for each UID"""
+        message_ids = {}
+        for chunk in _batched(uids, FETCH_CHUNK_SIZE):
+            response = client.fetch(chunk, [MESSAGE_ID_FETCH])
+            for uid, data in response.items():
+                header = email.message_from_bytes(data.get(MESSAGE_ID_RESPONSE, b''))
+                message_ids[uid] = header.get('Message-ID', '')
+        return message_ids
+    
+    def _filter_new_messages(self, client, uids: List[int]) -> List[int]:
         """
-        text_body = ''
-        html_body = ''
+        UIDs whose Message-ID is not stored yet
         
-        if email_message.is_multipart():
-            for part in email_message.walk():
-                content_type = part.get_content_type()
-                content_disposition = part.get_content_disposition()
-                
-                # Skip attachments
-                if content_disposition == 'attachment':
-                    continue
-                
-                try:
-                    payload = part.get_payload(decode=True)
-                    if payload:
-                        charset = part.get_content_charset() or 'utf-8'
-                        decoded_payload = payload.decode(charset, errors='ignore')
-                        
-                        if content_type == 'text/plain' and not text_body:
-                            text_body = decoded_payload
-                        elif content_type == 'text/html' and not html_body:
-                            html_body = decoded_payload
-                except Exception as e:
-                    logger.warning(f"Error extracting body part: {e}")
-        else:
-            # Not multipart
-            payload = email_message.get_payload(decode=True)
-            if payload:
-                charset = email_message.get_content_charset() or 'utf-8'
-                text_body = payload.decode(charset, errors='ignore')
+        One header-only FETCH and one query replace a full download and an
+        exists() query per message; duplicates within the batch are dropped too.
+        """
+        message_ids = self._fetch_message_ids(client, uids)
         
-        # If no text body but has HTML, extract text from HTML
-        if not text_body and html_body:
-            import re
-            # Simple HTML to text conversion
-            text_body = re.sub('<[^<]+?>', '', html_body)
-            text_body = text_body.replace('&nbsp;', ' ')
+        seen = set(
+            Email.objects.filter(
+                message_id__in=set(message_ids.values())
+            ).values_list('message_id', flat=True)
+        )
         
-        return text_body.strip(), html_body.strip()
+        new_uids = []
+        for uid in uids:
+            message_id = message_ids.get(uid)
+            if message_id is None or message_id in seen:
+                continue
+            seen.add(message_id)
+            new_uids.append(uid)
+        return new_uids
     
-    def _parse_date(self, date_str: str) -> datetime:
-        """Parse email date header"""
-        if not date_str:
-            return timezone.now()
-        
-        try:
-            from email.utils import parsedate_to_datetime
-            return parsedate_to_datetime(date_str)
-        except Exception:
-            return timezone.now()
+    def _fetch_bodies(self, client, uids: List[int]) -> Iterator[Tuple[int, Dict]]:
+        """Fetch full messages in chunks to stay under server command size limits"""
+        for chunk in _batched(uids, FETCH_CHUNK_SIZE):
+            response = client.fetch(chunk, ['RFC822', 'INTERNALDATE'])
+            yield from response.items()
     
     def test_connection(self) -> dict:
         """
@@ -253,8 +488,7 @@ class EmailFetcherService:
             dict with status and message
         """
         try:
-            with imapclient.IMAPClient(self.imap_host, port=self.imap_port, ssl=True) as client:
-                client.login(self.username, self.password)
+            with imap_pool.connection(self.imap_host, self.imap_port, self.username, self.password) as client:
                 folders = client.list_folders()
             
             return {
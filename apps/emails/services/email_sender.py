@@ -3,6 +3,7 @@ Email sender service using SMTP
 """
 import smtplib
 import logging
+from functools import lru_cache
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from typing import Optional, List
@@ -12,6 +13,77 @@ from apps.emails.models import Email, EmailReply
 
 logger = logging.getLogger(__name__)
 
+# HTML reply layout, split around the body so only the signature is formatted
+HTML_EMAIL_HEAD = """
+<!DOCTYPE html>
+<html>
+<head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <style>
+        body {
+            font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, 'Helvetica Neue', Arial, sans-serif;
+            line-height: 1.6;
+            color: #333;
+            max-width: 600px;
+            margin: 0 auto;
+            padding: 20px;
+        }
+        .email-container {
+            background-color: #ffffff;
+            border-radius: 8px;
+            padding: 30px;
+            box-shadow: 0 2px 4px rgba(0,0,0,0.1);
+        }
+        .email-body {
+            margin: 20px 0;
+            font-size: 14px;
+        }
+        .signature {
+            margin-top: 30px;
+            padding-top: 20px;
+            border-top: 1px solid #e0e0e0;
+            font-size: 13px;
+            color: #666;
+        }
+        .footer {
+            margin-top: 30px;
+            padding-top: 20px;
+            border-top: 1px solid #e0e0e0;
+            font-size: 12px;
+            color: #999;
+            text-align: center;
+        }
+    </style>
+</head>
+<body>
+    <div class="email-container">
+        <div class="email-body">
+"""
+
+HTML_EMAIL_TAIL = """
+        </div>
+        
+        <div class="signature">
+            <strong>Support Team</strong><br>
+            {from_email}<br>
+        </div>
+        
+        <div class="footer">
+            <p>This is an automated response from our support system.</p>
+            <p>If you need further assistance, please reply to this email.</p>
+        </div>
+    </div>
+</body>
+</html>
+"""
+
+
+@lru_cache(maxsize=4)
+def render_html_email_tail(from_email: str) -> str:
+    """Signature and footer for a sender address"""
+    return HTML_EMAIL_TAIL.format(from_email=from_email)
+
 
 class EmailSenderService:
     """
@@ -95,12 +167,15 @@ class EmailSenderService:
             # Update reply status
             reply_obj.status = 'sent'
             reply_obj.sent_at = timezone.now()
-            reply_obj.save()
+            reply_obj.save(update_fields=['status', 'sent_at', 'updated_at'])
             
             # Update email status
             email_obj.status = 'replied'
             email_obj.replied_at = timezone.now()
-            email_obj.save()
+            email_obj.response_time_seconds = max(
+                int((email_obj.replied_at - email_obj.received_at).total_seconds()), 0
+            )
+            email_obj.save(update_fields=['status', 'replied_at', 'response_time_seconds', 'updated_at'])
             
             return True
             
@@ -123,68 +198,7 @@ class EmailSenderService:
         # Convert line breaks to HTML
         html_body = body.replace('\n', '<br>')
         
-        html_template = f"""
-<!DOCTYPE html>
-<html>
-<head>
-    <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <style>
-        body {{
-            font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, 'Helvetica Neue', Arial, sans-serif;
-            line-height: 1.6;
-            color: #333;
-            max-width: 600px;
-            margin: 0 auto;
-            padding: 20px;
-        }}
-        .email-container {{
-            background-color: #ffffff;
-            border-radius: 8px;
-            padding: 30px;
-            box-shadow: 0 2px 4px rgba(0,0,0,0.1);
-        }}
-        .email-body {{
-            margin: 20px 0;
-            font-size: 14px;
-        }}
-        .signature {{
-            margin-top: 30px;
-            padding-top: 20px;
-            border-top: 1px solid #e0e0e0;
-            font-size: 13px;
-            color: #666;
-        }}
-        .footer {{
-            margin-top: 30px;
-            padding-top: 20px;
-            border-top: 1px solid #e0e0e0;
-            font-size: 12px;
-            color: #999;
-            text-align: center;
-        }}
-    </style>
-</head>
-<body>
-    <div class="email-container">
-        <div class="email-body">
-            {html_body}
-        </div>
-        
-        <div class="signature">
-            <strong>Support Team</strong><br>
-            {self.from_email}<br>
-        </div>
-        
-        <div class="footer">
-            <p>This is an automated response from our support system.</p>
-            <p>If you need further assistance, please reply to this email.</p>
-        </div>
-    </div>
-</body>
-</html>
-"""
-        return html_template
+        return HTML_EMAIL_HEAD + html_body + render_html_email_tail(self.from_email)
     
     def send_notification(self, 
                          to_email: str, 
@@ -195,19 +209,8 @@ class EmailSenderService:
         Send a notification email (e.g., to agents about escalations)
         """
         try:
-            msg = MIMEMultipart('alternative')
-            msg['From'] = self.from_email
+            msg = self._create_notification(subject, body, html_body)
             msg['To'] = to_email
-            msg['Subject'] = subject
-            
-            # Add plain text
-            text_part = MIMEText(body, 'plain', 'utf-8')
-            msg.attach(text_part)
-            
-            # Add HTML if provided
-            if html_body:
-                html_part = MIMEText(html_body, 'html', 'utf-8')
-                msg.attach(html_part)
             
             # Send
             with smtplib.SMTP(self.smtp_host, self.smtp_port) as server:
@@ -223,6 +226,70 @@ class EmailSenderService:
             logger.error(f"Error sending notification: {e}")
             return False
     
+    def send_notifications(self,
+                           recipients: List[str],
+                           subject: str,
+                           body: str,
+                           html_body: Optional[str] = None) -> int:
+        """
+        Send one notification to several recipients in a single SMTP transaction
+        
+        Recipients are Bcc'd (To is the sending account), so admins don't see
+        each other's addresses.
+        
+        Returns:
+            int: Number of recipients the notification was sent to
+        """
+        if not recipients:
+            return 0
+        
+        msg = self._create_notification(subject, body, html_body)
+        msg['To'] = self.from_email
+        msg['Bcc'] = ', '.join(recipients)
+        
+        try:
+            refused = self._send_once(msg, recipients)
+            for to_email, error in refused.items():
+                logger.error(f"Notification refused for {to_email}: {error}")
+            
+            sent = len(recipients) - len(refused)
+            logger.info(f"Notification sent to {sent} of {len(recipients)} recipients")
+            return sent
+            
+        except Exception as e:
+            logger.error(f"Error sending notifications: {e}")
+            return 0
+    
+    def _send_once(self, msg: MIMEMultipart, recipients: List[str]) -> dict:
+        """
+        Deliver a message to all recipients with one RCPT TO each and one DATA
+        
+        send_message() strips the Bcc header before transmitting.
+        Returns the recipients the server refused.
+        """
+        with smtplib.SMTP(self.smtp_host, self.smtp_port) as server:
+            if self.use_tls:
+                server.starttls()
+            server.login(self.username, self.password)
+            return server.send_message(msg, self.from_email, recipients)
+    
+    def _create_notification(self, subject: str, body: str, html_body: Optional[str] = None) -> MIMEMultipart:
+        """Build a notification message without recipients"""
+        msg = MIMEMultipart('alternative')
+        msg['From'] = self.from_email
+        msg['Subject'] = subject
+        
+        # Add plain text
+        text_part = MIMEText(body, 'plain', 'utf-8')
+        msg.attach(text_part)
+        
+        # Add HTML if provided
+        if html_body:
+            html_part = MIMEText(html_body, 'html', 'utf-8')
+            msg.attach(html_part)
+        
+        return msg
+    
     def test_connection(self) -> dict:
         """
         Test SMTP connection and credentials
@@ -254,4 +321,16 @@ class EmailSenderService:
             return {
                 'success': False,
                 'message': f'Connection error: {str(e)}'
-            }
\ No newline at end of file
+            }
+
+
+# Process-wide EmailSenderService, created on first use by get_sender()
+_sender = None
+
+
+def get_sender() -> EmailSenderService:
+    """Shared EmailSenderService; it holds only settings, so one per process is enough"""
+    global _sender
+    if _sender is None:
+        _sender = EmailSenderService()
+    return _sender
@@ -0,0 +1,84 @@
+"""
+Persistent IMAP connections, one per account per worker process
+"""
+import imaplib
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, Tuple
+import imapclient
+from imapclient.exceptions import IMAPClientError
+
+logger = logging.getLogger(__name__)
+
+# Connections idle longer than this are checked with NOOP before reuse
+IDLE_CHECK_SECONDS = 300
+
+# Errors after which a connection can no longer be trusted
+CONNECTION_ERRORS = (IMAPClientError, imaplib.IMAP4.abort, OSError)
+
+_pool_lock = threading.Lock()
+_account_locks: Dict[Tuple, threading.Lock] = {}
+_connections: Dict[Tuple, Tuple[imapclient.IMAPClient, float]] = {}
+
+
+def _account_lock(key: Tuple) -> threading.Lock:
+    with _pool_lock:
+        return _account_locks.setdefault(key, threading.Lock())
+
+
+def _open(host: str, port: int, username: str, password: str) -> imapclient.IMAPClient:
+    logger.info(f"Connecting to IMAP: {host}:{port}")
+    client = imapclient.IMAPClient(host, port=port, ssl=True)
+    # Timezone-aware INTERNALDATE values, stored directly as received_at
+    client.normalise_times = False
+    client.login(username, password)
+    logger.info("IMAP login successful")
+    return client
+
+
+def _discard(key: Tuple):
+    client, _ = _connections.pop(key, (None, None))
+    if client is None:
+        return
+    try:
+        client.logout()
+    except Exception:
+        pass
+
+
+@contextmanager
+def connection(host: str, port: int, username: str, password: str) -> Iterator[imapclient.IMAPClient]:
+    """
+    Check out the logged-in connection for an account
+    
+    Only one caller uses an account's connection at a time, so the pool never
+    opens more than one connection per account (server MAXPERIP limits).
+    A connection that fails is logged out and reopened on next checkout.
+    """
+    key = (host, port, username)
+    
+    with _account_lock(key):
+        client, last_used = _connections.get(key, (None, 0.0))
+        
+        if client is not None and time.monotonic() - last_used > IDLE_CHECK_SECONDS:
+            try:
+                client.noop()
+            except CONNECTION_ERRORS:
+                logger.info(f"Stale IMAP connection for {username}, reconnecting")
+                _discard(key)
+                client = None
+        
+        if client is None:
+            client = _open(host, port, username, password)
+        _connections[key] = (client, time.monotonic())
+        
+        try:
+            yield client
+        except CONNECTION_ERRORS:
+            _discard(key)
+            raise
+        finally:
+            if key in _connections:
+                _connections[key] = (client, time.monotonic())
@@ -0,0 +1,56 @@
+"""
+Buffered writes for email processing logs
+"""
+import logging
+from typing import Dict, Optional
+from apps.emails.models import EmailProcessingLog
+
+logger = logging.getLogger(__name__)
+
+
+class ProcessingLogBuffer:
+    """
+    Collect EmailProcessingLog rows for one email and write them in one INSERT
+    
+    Usable as a context manager; the buffer is flushed on exit, including
+    when processing fails.
+    """
+    
+    def __init__(self, email_id: int):
+        self.email_id = email_id
+        self.entries = []
+    
+    def add(self,
+            step: str,
+            status: str,
+            details: Optional[Dict] = None,
+            error_message: str = '',
+            processing_time: Optional[float] = None):
+        """Queue a log entry for this email"""
+        self.entries.append(EmailProcessingLog(
+            email_id=self.email_id,
+            step=step,
+            status=status,
+            details={} if details is None else details,
+            error_message=error_message,
+            processing_time=processing_time,
+        ))
+    
+    def flush(self):
+        """Write queued entries; logging failures never break processing"""
+        if not self.entries:
+            return
+        
+        try:
+            EmailProcessingLog.objects.bulk_create(self.entries, batch_size=100)
+        except Exception as e:
+            logger.error(f"Error saving processing logs for email {self.email_id}: {e}")
+        finally:
+            self.entries = []
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
+        return False
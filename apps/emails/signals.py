@@ -0,0 +1,29 @@
+"""
+Signal handlers for the emails app
+"""
+from django.contrib.auth.models import User
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from apps.emails.cache import (
+    invalidate_admin_emails_cache, invalidate_category_cache, invalidate_kb_search_cache
+)
+from apps.emails.models import EmailCategory, KnowledgeBase
+
+
+@receiver([post_save, post_delete], sender=EmailCategory)
+def clear_category_cache(sender, **kwargs):
+    """Keep cached categories in sync with the table"""
+    invalidate_category_cache()
+
+
+@receiver([post_save, post_delete], sender=User)
+def clear_admin_emails_cache(sender, **kwargs):
+    """Staff changes take effect on the next escalation"""
+    invalidate_admin_emails_cache()
+
+
+@receiver([post_save, post_delete], sender=KnowledgeBase)
+def clear_kb_search_cache(sender, **kwargs):
+    """Article edits show up in keyword search immediately"""
+    invalidate_kb_search_cache()
@@ -2,20 +2,102 @@
 Celery tasks for email processing
 """
 import logging
-from celery import shared_task
+import re
+from concurrent.futures import ThreadPoolExecutor
+from celery import group, shared_task
+from django.contrib.postgres.search import SearchQuery, SearchRank
+from django.db.models import F
 from django.utils import timezone
 from django.conf import settings
 from datetime import timedelta
 
-from apps.emails.models import Email, EmailReply, EmailCategory, KnowledgeBase, EmailProcessingLog
+from apps.emails.cache import get_admin_emails, get_category_by_name, get_category_keywords
+from apps.emails.models import (
+    Email, EmailReply, KnowledgeBase, EmailProcessingLog,
+    KB_SEARCH_VECTOR
+)
 from apps.emails.services.email_fetcher import EmailFetcherService
-from apps.emails.services.claude_service import ClaudeEmailAgent
-from apps.emails.services.email_sender import EmailSenderService
+from apps.emails.services.claude_service import ClaudeEmailAgent, add_greeting, match_keyword_category
+from apps.emails.services.email_sender import get_sender
+from apps.emails.services.processing_log import ProcessingLogBuffer
 
 logger = logging.getLogger(__name__)
 
+# Email columns written once classification is known
+CLASSIFICATION_FIELDS = [
+    'category', 'priority', 'ai_sentiment', 'ai_classification_confidence',
+    'requires_escalation', 'escalation_reason', 'ai_extracted_info',
+    'processed_at', 'updated_at',
+]
 
-@shared_task(bind=True, max_retries=3)
+# Cap on words taken from an email when searching the knowledge base
+MAX_SEARCH_TERMS = 20
+SEARCH_TERM_RE = re.compile(r'\w{3,}')
+
+# Drafts replies while classification is in flight (see start_speculative_reply);
+# threads start on first use, after the worker process has forked
+_speculation_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='speculative-reply')
+
+# Processing log rows removed per DELETE statement
+LOG_CLEANUP_CHUNK_SIZE = 10000
+
+# Most recent replied threads excluded from the IMAP search when enabled
+EXCLUDED_THREADS_LIMIT = 100
+
+
+def find_knowledge_articles(category, *texts, limit=3):
+    """
+    Most relevant active articles in a category for the given texts
+    
+    Articles are ranked by full-text match (served by the kb_search_gin index),
+    falling back to the most used articles when nothing matches.
+    """
+    articles = KnowledgeBase.objects.filter(category=category, is_active=True)
+    
+    terms = SEARCH_TERM_RE.findall(' '.join(texts))[:MAX_SEARCH_TERMS]
+    if terms:
+        # Any term may match; SearchRank orders by how well each article does
+        query = SearchQuery(' or '.join(terms), config='english', search_type='websearch')
+        matches = list(
+            articles.annotate(
+                search=KB_SEARCH_VECTOR
+            ).filter(
+                search=query
+            ).annotate(
+                rank=SearchRank(F('search'), query)
+            ).order_by('-rank', '-use_count')[:limit]
+        )
+        if matches:
+            return matches
+    
+    return list(articles.order_by('-use_count')[:limit])
+
+
+def start_speculative_reply(agent, email):
+    """
+    Start drafting a reply for the keyword-guessed category in the background
+    
+    Runs while Claude classifies the email, so a correct guess saves one round
+    trip. Returns (category name, article ids, future), or None without a guess.
+    The draft has no greeting; the customer name comes with the classification.
+    The knowledge base is queried here because the worker thread has no
+    database connection of its own.
+    """
+    guess = match_keyword_category(f"{email.subject}\n{email.body}", get_category_keywords())
+    category = get_category_by_name(guess) if guess else None
+    if category is None:
+        return None
+    
+    # issue_summary is not known yet; the body stands in for it
+    kb_articles = find_knowledge_articles(category, email.subject, email.body)
+    future = _speculation_executor.submit(
+        agent.generate_reply, email.subject, email.body, guess, None, kb_articles, greet=False
+    )
+    return guess, {article.pk for article in kb_articles}, future
+
+
+# Redelivery cannot duplicate emails: the unique message_id skips stored ones
+@shared_task(bind=True, max_retries=3, acks_late=True)
 def fetch_emails_task(self):
     """
     Periodic task to fetch new emails from IMAP
@@ -23,14 +105,23 @@ def fetch_emails_task(self):
     try:
         logger.info("Starting email fetch task...")
         
+        # Optionally have the server skip replies to threads we already answered
+        exclude_thread_ids = None
+        if settings.EMAIL_FETCH_EXCLUDE_REPLIED_THREADS:
+            exclude_thread_ids = list(
+                Email.objects.filter(status='replied')
+                .order_by('-received_at')
+                .values_list('message_id', flat=True)[:EXCLUDED_THREADS_LIMIT]
+            )
+        
         fetcher = EmailFetcherService()
-        new_emails = fetcher.fetch_new_emails(limit=50)
+        new_emails = fetcher.fetch_new_emails(limit=50, exclude_thread_ids=exclude_thread_ids)
         
         logger.info(f"Fetched {len(new_emails)} new emails")
         
-        # Queue processing for each email
-        for email_obj in new_emails:
-            process_email_task.delay(email_obj.id)
+        # Queue processing for every email in one group publish
+        if new_emails:
+            group(process_email_task.s(email_obj.id) for email_obj in new_emails).apply_async()
         
         return {
             'success': True,
@@ -44,195 +135,239 @@ def fetch_emails_task(self):
         raise self.retry(exc=e, countdown=60 * (2 ** self.request.retries))
 
 
-@shared_task(bind=True, max_retries=3)
-def process_email_task(self, email_id):
+@shared_task(bind=True, max_retries=3, ignore_result=False)  # the API returns this task's id for status polling
+def process_email_task(self, email_id, classification=None, prepared_reply=None, kb_article_ids=None):
     """
     Process a single email: classify and generate reply
+    
+    A classification computed ahead of time (see bulk_process_emails_task)
+    skips the classification call to Claude; so does a prepared reply, with
+    the ids of the articles it was generated from.
     """
     start_time = timezone.now()
     
-    try:
-        email = Email.objects.get(id=email_id)
-        logger.info(f"Processing email: {email.subject[:50]}")
-        
-        # Update status
-        email.status = 'processing'
-        email.save()
-        
-        # Log: Started classification
-        EmailProcessingLog.objects.create(
-            email=email,
-            step='classification',
-            status='started',
-            details={'started_at': start_time.isoformat()}
-        )
-        
-        # Step 1: Classify email
-        agent = ClaudeEmailAgent()
-        classification = agent.classify_email(email.subject, email.body)
-        
-        # Update email with classification
-        category = EmailCategory.objects.filter(name=classification['category']).first()
-        email.category = category
-        email.priority = classification['priority']
-        email.ai_sentiment = classification['sentiment']
-        email.ai_classification_confidence = classification['confidence']
-        email.requires_escalation = classification['requires_escalation']
-        email.escalation_reason = classification.get('escalation_reason', '')
-        email.ai_extracted_info = classification.get('extracted_info', {})
-        email.processed_at = timezone.now()
-        email.save()
-        
-        # Log: Classification completed
-        EmailProcessingLog.objects.create(
-            email=email,
-            step='classification',
-            status='completed',
-            details=classification,
-            processing_time=(timezone.now() - start_time).total_seconds()
-        )
-        
-        logger.info(f"Email classified as: {classification['category']} (confidence: {classification['confidence']})")
-        
-        # Step 2: Generate reply (if not escalated)
-        if not email.requires_escalation:
-            reply_start = timezone.now()
+    # Log rows are written together when processing finishes or fails
+    with ProcessingLogBuffer(email_id) as logs:
+        try:
+            # The HTML body and attachment metadata play no part in processing
+            email = Email.objects.defer('body_html', 'attachments_data').get(id=email_id)
+            logger.info(f"Processing email: {email.subject[:50]}")
             
-            # Log: Started reply generation
-            EmailProcessingLog.objects.create(
-                email=email,
-                step='reply_generation',
+            # Update status
+            email.status = 'processing'
+            email.save(update_fields=['status', 'updated_at'])
+            
+            # Log: Started classification
+            logs.add(
+                step='classification',
                 status='started',
-                details={'started_at': reply_start.isoformat()}
+                details={'started_at': start_time.isoformat()}
             )
             
-            # Get relevant knowledge base articles
-            kb_articles = []
-            if category:
-                kb_articles = list(
-                    KnowledgeBase.objects.filter(
-                        category=category,
-                        is_active=True
-                    ).order_by('-use_count')[:3]
-                )
-            
-            # Extract customer name
-            customer_name = email.ai_extracted_info.get('customer_name', email.from_name)
+            # Step 1: Classify email
+            agent = ClaudeEmailAgent()
+            speculative = None
+            if classification is None:
+                speculative = start_speculative_reply(agent, email)
+                classification = agent.classify_email(email.subject, email.body)
             
-            # Generate reply
-            reply_data = agent.generate_reply(
-                email.subject,
-                email.body,
-                classification['category'],
-                customer_name,
-                kb_articles
-            )
+            # Update email with classification
+            category = get_category_by_name(classification['category'])
+            email.category = category
+            email.priority = classification['priority']
+            email.ai_sentiment = classification['sentiment']
+            email.ai_classification_confidence = classification['confidence']
+            email.requires_escalation = classification['requires_escalation']
+            email.escalation_reason = classification.get('escalation_reason', '')
+            email.ai_extracted_info = classification.get('extracted_info', {})
+            email.processed_at = timezone.now()
+            email.save(update_fields=CLASSIFICATION_FIELDS)
             
-            # Create EmailReply object
-            reply = EmailReply.objects.create(
-                email=email,
-                body=reply_data['reply'],
-                source='ai',
-                ai_confidence=reply_data['confidence'],
-                status='pending_approval' if reply_data['requires_review'] else 'draft'
-            )
-            
-            # Link knowledge base articles
-            if kb_articles:
-                reply.knowledge_base_articles.set(kb_articles)
-                # Increment use count
-                for article in kb_articles:
-                    article.use_count += 1
-                    article.save()
-                    # Log: Reply generation completed
-            EmailProcessingLog.objects.create(
-                email=email,
-                step='reply_generation',
+            # Log: Classification completed
+            logs.add(
+                step='classification',
                 status='completed',
-                details={
-                    'confidence': reply_data['confidence'],
-                    'requires_review': reply_data['requires_review'],
-                    'used_articles': reply_data.get('used_articles', [])
-                },
-                processing_time=(timezone.now() - reply_start).total_seconds()
+                details=classification,
+                processing_time=(timezone.now() - start_time).total_seconds()
             )
             
-            logger.info(f"Reply generated with confidence: {reply_data['confidence']}")
+            logger.info(f"Email classified as: {classification['category']} (confidence: {classification['confidence']})")
             
-            # Auto-approve and send if confidence is high enough
-            if (reply_data['confidence'] >= settings.EMAIL_AUTO_REPLY_THRESHOLD and 
-                not reply_data['requires_review']):
+            # Step 2: Generate reply (if not escalated)
+            if not email.requires_escalation:
+                reply_start = timezone.now()
+                
+                # Log: Started reply generation
+                logs.add(
+                    step='reply_generation',
+                    status='started',
+                    details={'started_at': reply_start.isoformat()}
+                )
+                
+                reply_data = prepared_reply
+                kb_article_ids = kb_article_ids or []
+                if reply_data is None:
+                    # Get relevant knowledge base articles
+                    kb_articles = []
+                    if category:
+                        kb_articles = find_knowledge_articles(
+                            category,
+                            email.subject,
+                            email.ai_extracted_info.get('issue_summary', '')
+                        )
+                    kb_article_ids = [article.pk for article in kb_articles]
+                    
+                    # Extract customer name
+                    customer_name = email.ai_extracted_info.get('customer_name', email.from_name)
+                    
+                    if (speculative and speculative[0] == classification['category']
+                            and speculative[1] == set(kb_article_ids)):
+                        # The keyword guess was right and drew on the same articles;
+                        # use the draft started alongside classification
+                        try:
+                            reply_data = speculative[2].result()
+                            reply_data['reply'] = add_greeting(reply_data['reply'], customer_name)
+                        except Exception as e:
+                            logger.warning(f"Speculative reply failed, generating again: {e}")
+                    
+                    if reply_data is None:
+                        # Generate reply
+                        reply_data = agent.generate_reply(
+                            email.subject,
+                            email.body,
+                            classification['category'],
+                            customer_name,
+                            kb_articles
+                        )
+                
+                # Create EmailReply object
+                reply = EmailReply.objects.create(
+                    email=email,
+                    body=reply_data['reply'],
+                    source='ai',
+                    ai_confidence=reply_data['confidence'],
+                    status='pending_approval' if reply_data['requires_review'] else 'draft'
+                )
+                
+                # Link knowledge base articles
+                if kb_article_ids:
+                    reply.knowledge_base_articles.set(kb_article_ids)
+                    # Increment use count with a single UPDATE
+                    KnowledgeBase.objects.filter(
+                        pk__in=kb_article_ids
+                    ).update(use_count=F('use_count') + 1)
+                        # Log: Reply generation completed
+                logs.add(
+                    step='reply_generation',
+                    status='completed',
+                    details={
+                        'confidence': reply_data['confidence'],
+                        'requires_review': reply_data['requires_review'],
+                        'used_articles': reply_data.get('used_articles', [])
+                    },
+                    processing_time=(timezone.now() - reply_start).total_seconds()
+                )
                 
-                reply.status = 'approved'
-                reply.save()
+                logger.info(f"Reply generated with confidence: {reply_data['confidence']}")
                 
-                # Send email automatically
-                try:
-                    sender = EmailSenderService()
-                    sender.send_reply(email, reply)
+                # Auto-approve and send if confidence is high enough
+                if (reply_data['confidence'] >= settings.EMAIL_AUTO_REPLY_THRESHOLD and 
+                    not reply_data['requires_review']):
                     
-                    logger.info(f"Reply auto-sent for email: {email.subject[:50]}")
+                    reply.status = 'approved'
+                    reply.save(update_fields=['status', 'updated_at'])
                     
-                    # Log: Auto-send completed
-                    EmailProcessingLog.objects.create(
-                        email=email,
-                        step='auto_send',
-                        status='completed',
-                        details={'reply_id': reply.id}
-                    )
-                except Exception as send_error:
-                    logger.error(f"Error auto-sending reply: {send_error}")
-                    EmailProcessingLog.objects.create(
-                        email=email,
-                        step='auto_send',
-                        status='failed',
-                        error_message=str(send_error)
-                    )
+                    # Send email automatically
+                    try:
+                        sender = get_sender()
+                        sender.send_reply(email, reply)
+                        
+                        logger.info(f"Reply auto-sent for email: {email.subject[:50]}")
+                        
+                        # Log: Auto-send completed
+                        logs.add(
+                            step='auto_send',
+                            status='completed',
+                            details={'reply_id': reply.id}
+                        )
+                    except Exception as send_error:
+                        logger.error(f"Error auto-sending reply: {send_error}")
+                        logs.add(
+                            step='auto_send',
+                            status='failed',
+                            error_message=str(send_error)
+                        )
+                else:
+                    # Mark email for review
+                    email.status = 'pending_review'
+                    email.save(update_fields=['status', 'updated_at'])
+                    logger.info(f"Email marked for review: {email.subject[:50]}")
+            
             else:
-                # Mark email for review
-                email.status = 'pending_review'
-                email.save()
-                logger.info(f"Email marked for review: {email.subject[:50]}")
-        
-        else:
-            # Email requires escalation
-            email.status = 'escalated'
-            email.save()
-            logger.info(f"Email escalated: {email.subject[:50]}")
+                # Email requires escalation
+                email.status = 'escalated'
+                email.save(update_fields=['status', 'updated_at'])
+                logger.info(f"Email escalated: {email.subject[:50]}")
+                
+                # Send notification to admins
+                send_escalation_notification_task.delay(email_id)
             
-            # Send notification to admins
-            send_escalation_notification_task.delay(email_id)
-        
-        return {
-            'success': True,
-            'email_id': email_id,
-            'category': classification['category'],
-            'requires_escalation': email.requires_escalation
-        }
-        
-    except Email.DoesNotExist:
-        logger.error(f"Email not found: {email_id}")
-        return {'success': False, 'error': 'Email not found'}
-    
-    except Exception as e:
-        logger.error(f"Error processing email {email_id}: {e}")
+            return {
+                'success': True,
+                'email_id': email_id,
+                'category': classification['category'],
+                'requires_escalation': email.requires_escalation
+            }
+            
+        except Email.DoesNotExist:
+            logger.error(f"Email not found: {email_id}")
+            return {'success': False, 'error': 'Email not found'}
         
-        # Log error
-        try:
-            email = Email.objects.get(id=email_id)
-            EmailProcessingLog.objects.create(
-                email=email,
+        except Exception as e:
+            logger.error(f"Error processing email {email_id}: {e}")
+            
+            # Log error
+            logs.add(
                 step='processing',
                 status='failed',
                 error_message=str(e)
             )
-            email.status = 'new'  # Reset to new for retry
-            email.save()
-        except:
-            pass
-        
-        # Retry with exponential backoff
-        raise self.retry(exc=e, countdown=60 * (2 ** self.request.retries))
+            try:
+                # Reset to new for retry
+                Email.objects.filter(id=email_id).update(status='new', updated_at=timezone.now())
+            except:
+                pass
+            
+            # Retry with exponential backoff
+            raise self.retry(exc=e, countdown=60 * (2 ** self.request.retries))
+
+
+# The API returns this task's id for status polling. Safe to redeliver:
+# only approved replies are sent
+@shared_task(bind=True, max_retries=3, ignore_result=False, acks_late=True)
+def send_reply_task(self, reply_id):
+    """
+    Send an approved reply over SMTP
+    
+    Queued by the reply API so requests never wait on the mail server.
+    """
+    try:
+        reply = EmailReply.objects.select_related('email').get(id=reply_id)
+    except EmailReply.DoesNotExist:
+        logger.error(f"Reply {reply_id} not found")
+        return
+    
+    # A retry may run after an earlier attempt already went through
+    if reply.status != 'approved':
+        logger.info(f"Reply {reply_id} is {reply.status}, not sending")
+        return
+    
+    try:
+        get_sender().send_reply(reply.email, reply)
+        logger.info(f"Reply {reply_id} sent")
+    except Exception as e:
+        logger.error(f"Error sending reply {reply_id}: {e}")
+        raise self.retry(exc=e, countdown=60)
 
 
 @shared_task
@@ -244,17 +379,13 @@ def send_escalation_notification_task(email_id):
         email = Email.objects.get(id=email_id)
         
         # Get admin emails
-        from django.contrib.auth.models import User
-        admin_emails = User.objects.filter(
-            is_staff=True, 
-            is_active=True
-        ).values_list('email', flat=True)
+        admin_emails = get_admin_emails()
         
         if not admin_emails:
             logger.warning("No admin emails found for escalation notification")
             return
         
-        sender = EmailSenderService()
+        sender = get_sender()
         
         subject = f"[ESCALATION] {email.subject}"
         body = f"""
@@ -276,8 +407,8 @@ Email Body:
 {email.body[:500]}...
 """
         
-        for admin_email in admin_emails:
-            sender.send_notification(admin_email, subject, body)
+        # One SMTP session for every admin
+        sender.send_notifications(admin_emails, subject, body)
         
         logger.info(f"Escalation notification sent for email {email_id}")
         
@@ -289,13 +420,24 @@ Email Body:
 def cleanup_old_logs_task():
     """
     Clean up old processing logs (older than 90 days)
+    
+    Rows are deleted in bounded chunks, each its own statement and
+    transaction, so locks stay short and vacuum can keep up.
     """
     try:
         cutoff_date = timezone.now() - timedelta(days=90)
+        old_logs = EmailProcessingLog.objects.filter(created_at__lt=cutoff_date)
         
-        deleted_count = EmailProcessingLog.objects.filter(
-            created_at__lt=cutoff_date
-        ).delete()[0]
+        deleted_count = 0
+        while True:
+            # Nothing references log rows, so this is a single
+            # DELETE ... WHERE id IN (SELECT id ... LIMIT n)
+            deleted = EmailProcessingLog.objects.filter(
+                pk__in=old_logs.values('pk')[:LOG_CLEANUP_CHUNK_SIZE]
+            ).delete()[0]
+            deleted_count += deleted
+            if deleted < LOG_CLEANUP_CHUNK_SIZE:
+                break
         
         logger.info(f"Cleaned up {deleted_count} old processing logs")
         
@@ -309,18 +451,61 @@ def cleanup_old_logs_task():
         return {'success': False, 'error': str(e)}
 
 
-@shared_task
+@shared_task(ignore_result=False)  # callers read group_id/task_ids from the result
 def bulk_process_emails_task(email_ids):
     """
     Process multiple emails in bulk
+    
+    Classifications for the whole batch are requested from Claude
+    concurrently, then replies for every email that needs no escalation;
+    each email is then processed with its results.
     """
-    results = []
-    for email_id in email_ids:
-        result = process_email_task.delay(email_id)
-        results.append(result.id)
+    emails = Email.objects.filter(id__in=email_ids).only('id', 'subject', 'body', 'from_name')
+    emails = list(emails)
+    
+    agent = ClaudeEmailAgent()
+    classifications = agent.classify_emails([(email.subject, email.body) for email in emails])
+    
+    # Knowledge base lookups happen here; the event loop cannot use the ORM
+    reply_inputs = {}
+    article_ids = {}
+    for email, classification in zip(emails, classifications):
+        if classification is None or classification['requires_escalation']:
+            continue
+        
+        extracted_info = classification.get('extracted_info', {})
+        category = get_category_by_name(classification['category'])
+        kb_articles = []
+        if category:
+            kb_articles = find_knowledge_articles(
+                category, email.subject, extracted_info.get('issue_summary', '')
+            )
+        reply_inputs[email.id] = (
+            email.subject,
+            email.body,
+            classification['category'],
+            extracted_info.get('customer_name', email.from_name),
+            kb_articles,
+        )
+        article_ids[email.id] = [article.pk for article in kb_articles]
+    
+    replies = dict(zip(reply_inputs, agent.generate_replies(list(reply_inputs.values()))))
+    
+    # Failed classifications and replies (None) are retried inside process_email_task
+    result = group(
+        process_email_task.s(
+            email.id,
+            classification=classification,
+            prepared_reply=replies.get(email.id),
+            kb_article_ids=article_ids.get(email.id),
+        )
+        for email, classification in zip(emails, classifications)
+    ).apply_async()
     
+    task_ids = [task.id for task in result.results]
     return {
         'success': True,
-        'task_ids': results,
-        'count': len(results)
+        'group_id': result.id,
+        'task_ids': task_ids,
+        'count': len(task_ids)
     }
\ No newline at end of file
@@ -1,3 +1,101 @@
-from django.test import TestCase
+import email
 
-# Create your tests here.
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+
+from apps.emails.models import Email
+from apps.emails.services.claude_service import ClaudeEmailAgent
+from apps.emails.services.email_fetcher import (
+    EmailFetcherService, _parse_single_part, extract_body, parse_raw_email
+)
+
+
+def make_email(message_id, subject='Help with my order'):
+    return Email(
+        message_id=message_id,
+        from_email='customer@example.com',
+        to_email='support@example.com',
+        subject=subject,
+        body='Where is my order?',
+        received_at=timezone.now(),
+        status='new',
+    )
+
+
+@override_settings(ANTHROPIC_API_KEY='test-key')
+class MaskSensitiveDataTests(SimpleTestCase):
+    def setUp(self):
+        self.agent = ClaudeEmailAgent()
+    
+    def test_repeated_password_is_masked(self):
+        text = "password: hunter2\nTo confirm: hunter2 (hunter2)."
+        masked, mapping = self.agent.mask_sensitive_data(text)
+        
+        self.assertNotIn('hunter2', masked)
+        self.assertEqual(masked.count('[PASSWORD_0]'), 3)
+        self.assertEqual(mapping, {'[PASSWORD_0]': 'hunter2'})
+        self.assertEqual(self.agent.unmask_sensitive_data(masked, mapping), text)
+
+
+class ParseSinglePartTests(SimpleTestCase):
+    RAW = (
+        b'Message-ID: <plain-1@example.com>\r\n'
+        b'From: Jane Doe <jane@example.com>\r\n'
+        b'To: support@example.com\r\n'
+        b'Subject: =?utf-8?q?Caf=C3=A9_order?=\r\n'
+        b'Date: Mon, 05 Oct 2026 09:30:00 +0000\r\n'
+        b'Content-Type: text/plain; charset="utf-8"\r\n'
+        b'Content-Transfer-Encoding: 8bit\r\n'
+        b'\r\n'
+        b'Hello,\r\nmy caf\xc3\xa9 order never arrived.\r\n'
+    )
+    
+    def test_fast_path_matches_full_parser(self):
+        self.assertIsNotNone(_parse_single_part(self.RAW))
+        
+        message = email.message_from_bytes(self.RAW)
+        text_body, html_body = extract_body(message)
+        fields = parse_raw_email(self.RAW)
+        
+        self.assertEqual(fields['body'], text_body)
+        self.assertEqual(fields['body_html'], html_body)
+        self.assertEqual(fields['message_id'], message['Message-ID'])
+        self.assertEqual(fields['subject'], 'Café order')
+        self.assertEqual((fields['from_email'], fields['from_name']), ('jane@example.com', 'Jane Doe'))
+        self.assertFalse(fields['has_attachments'])
+    
+    def test_multipart_uses_full_parser(self):
+        raw = (
+            b'Content-Type: multipart/alternative; boundary="b"\r\n\r\n'
+            b'--b\r\nContent-Type: text/plain\r\n\r\nHi\r\n--b--\r\n'
+        )
+        self.assertIsNone(_parse_single_part(raw))
+
+
+class SaveEmailsTests(TestCase):
+    def setUp(self):
+        self.fetcher = EmailFetcherService()
+    
+    def test_duplicates_within_batch_are_inserted_once(self):
+        created = self.fetcher._save_emails([
+            make_email('<a@example.com>'),
+            make_email('<a@example.com>'),
+            make_email('<b@example.com>'),
+        ])
+        
+        self.assertEqual([obj.message_id for obj in created], ['<a@example.com>', '<b@example.com>'])
+        self.assertTrue(all(obj.pk for obj in created))
+        self.assertEqual(Email.objects.count(), 2)
+    
+    def test_existing_rows_are_not_returned(self):
+        existing = make_email('<a@example.com>')
+        existing.save()
+        
+        created = self.fetcher._save_emails([
+            make_email('<a@example.com>', subject='Sent again'),
+            make_email('<b@example.com>'),
+        ])
+        
+        self.assertEqual([obj.message_id for obj in created], ['<b@example.com>'])
+        self.assertEqual(Email.objects.get(pk=existing.pk).subject, 'Help with my order')
+        self.assertEqual(Email.objects.count(), 2)
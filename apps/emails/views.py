@@ -4,26 +4,95 @@ API Views for Email Management
 from rest_framework import viewsets, status, filters
 from rest_framework.decorators import action
 from rest_framework.response import Response
+from rest_framework.pagination import CursorPagination
 from rest_framework.permissions import IsAuthenticated
 from django_filters.rest_framework import DjangoFilterBackend
+from django.contrib.postgres.aggregates import ArrayAgg
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import transaction
+from django.http import HttpResponse
 from django.utils import timezone
-from django.db.models import Q, Count
+from django.db.models import Q, Case, Count, Prefetch, Value, When
 import logging
+from urllib.parse import urlencode
+import orjson
 
+from apps.emails.cache import get_kb_search_results, invalidate_kb_search_cache
 from apps.emails.models import (
     Email, EmailReply, EmailCategory, 
-    KnowledgeBase
+    KnowledgeBase, EMAIL_LIST_FIELDS, EMAIL_OVERDUE_EXPRESSION
 )
 from apps.emails.serializers import (
     EmailListSerializer, EmailDetailSerializer,
-    EmailReplySerializer, EmailCategorySerializer,
+    EmailReplySerializer, EmailReplyListSerializer, EmailReplyDetailSerializer,
+    EmailCategorySerializer,
     KnowledgeBaseSerializer, ReplyApprovalSerializer
 )
-from apps.emails.services.email_sender import EmailSenderService
-from apps.emails.tasks import process_email_task
+from apps.emails.tasks import process_email_task, send_reply_task
 
 logger = logging.getLogger(__name__)
 
+# Statuses counted individually by EmailViewSet.stats
+STATS_STATUSES = ('new', 'processing', 'pending_review', 'replied', 'escalated', 'closed')
+
+# Stats are the same for every user; keyed by the ?status filter only
+STATS_CACHE_KEY_PREFIX = 'email_stats_v1'
+STATS_CACHE_TIMEOUT = 30  # seconds
+
+# User columns needed for assigned_to_name
+ASSIGNEE_NAME_FIELDS = ('id', 'username', 'first_name', 'last_name')
+
+# EmailReply columns written when a reviewer approves or rejects a reply
+REVIEW_FIELDS = ['status', 'reviewed_by', 'reviewed_at', 'review_notes', 'updated_at']
+
+# KnowledgeBaseSerializer columns, with only the joined names it renders
+KB_ARTICLE_FIELDS = (
+    'id', 'category', 'category__name', 'title', 'content', 'keywords',
+    'use_count', 'is_active', 'created_by', 'created_by__username',
+    'created_at', 'updated_at',
+)
+
+# Reply listings only show the titles of the articles used
+ARTICLE_TITLES_PREFETCH = Prefetch(
+    'knowledge_base_articles',
+    queryset=KnowledgeBase.objects.only('id', 'title')
+)
+
+
+def fast_json(data, status=200):
+    """
+    JSON response serialized with orjson, skipping DRF's renderer negotiation
+    
+    For small fixed-shape payloads from hot actions; authentication and
+    permissions still run through the viewset as usual.
+    """
+    return HttpResponse(orjson.dumps(data), status=status, content_type='application/json')
+
+
+def review_summary(reply_obj):
+    """Fields a review changes; clients fetch the reply itself for the rest"""
+    return {
+        'id': reply_obj.id,
+        'email': reply_obj.email_id,
+        'status': reply_obj.status,
+        'reviewed_by': reply_obj.reviewed_by_id,
+        'reviewed_at': reply_obj.reviewed_at,
+        'review_notes': reply_obj.review_notes,
+    }
+
+
+class EmailCursorPagination(CursorPagination):
+    """Keyset pagination on received_at; page depth doesn't slow the query"""
+    ordering = '-received_at'
+    page_size = 50
+
+
+class EmailReplyCursorPagination(CursorPagination):
+    """Keyset pagination on created_at"""
+    ordering = '-created_at'
+    page_size = 50
+
 
 class EmailViewSet(viewsets.ModelViewSet):
     """
@@ -35,11 +104,43 @@ class EmailViewSet(viewsets.ModelViewSet):
     search_fields = ['from_email', 'subject', 'body']
     ordering_fields = ['received_at', 'created_at', 'priority']
     ordering = ['-received_at']
+    pagination_class = EmailCursorPagination
+    # escalate/mark_spam filter and int() the raw pk; anything else is a 404
+    lookup_value_regex = r'\d+'
     
     def get_queryset(self):
-        queryset = Email.objects.select_related(
-            'category', 'assigned_to'
-        ).prefetch_related('replies')
+        if self.action == 'stats':
+            # Aggregates only; related rows would just widen the scans
+            queryset = Email.objects.all()
+        elif self.action == 'list':
+            # Few agents are assigned across many rows; load each one once, by name only
+            queryset = Email.objects.select_related('category').prefetch_related(
+                Prefetch('assigned_to', queryset=User.objects.only(*ASSIGNEE_NAME_FIELDS))
+            )
+        else:
+            queryset = Email.objects.select_related('category', 'assigned_to')
+        
+        if self.action == 'list':
+            # Counted in the list query instead of one COUNT per row
+            queryset = queryset.annotate(
+                replies_count=Count('replies'),
+                overdue=EMAIL_OVERDUE_EXPRESSION
+            ).only(*EMAIL_LIST_FIELDS)
+            
+            # ?overdue=true lists only emails past their category SLA
+            if self.request.query_params.get('overdue') == 'true':
+                queryset = queryset.filter(overdue=True)
+        elif self.action == 'retrieve':
+            # Nested replies, their articles and the processing log in a fixed number of queries
+            queryset = queryset.prefetch_related(
+                Prefetch(
+                    'replies',
+                    queryset=EmailReply.objects.select_related(
+                        'created_by', 'reviewed_by'
+                    ).prefetch_related(ARTICLE_TITLES_PREFETCH)
+                ),
+                'processing_logs'
+            )
         
         # Filter by status if provided
         status_param = self.request.query_params.get('status')
@@ -60,17 +161,21 @@ class EmailViewSet(viewsets.ModelViewSet):
         user_id = request.data.get('user_id')
         
         try:
-            from django.contrib.auth.models import User
             user = User.objects.get(id=user_id)
             
             email_obj.assigned_to = user
             email_obj.assigned_at = timezone.now()
             email_obj.status = 'processing'
-            email_obj.save()
+            email_obj.save(update_fields=['assigned_to', 'assigned_at', 'status', 'updated_at'])
             
-            return Response({
+            return fast_json({
                 'message': f'Email assigned to {user.get_full_name()}',
-                'email': EmailDetailSerializer(email_obj).data
+                'email': {
+                    'id': email_obj.id,
+                    'status': email_obj.status,
+                    'assigned_to': user.id,
+                    'assigned_at': email_obj.assigned_at
+                }
             })
         except User.DoesNotExist:
             return Response(
@@ -78,69 +183,149 @@ class EmailViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_404_NOT_FOUND
             )
     
+    @action(detail=False, methods=['post'])
+    def assign_bulk(self, request):
+        """
+        Assign many emails at once
+        
+        Body: {"assignments": [{"email_id": 1, "user_id": 2}, ...]}
+        One query checks the users and one UPDATE assigns every email.
+        """
+        try:
+            assignments = {
+                int(item['email_id']): int(item['user_id'])
+                for item in request.data.get('assignments', [])
+            }
+        except (AttributeError, TypeError, KeyError, ValueError):
+            # AttributeError: the body itself is a JSON list or scalar
+            return Response(
+                {'error': 'assignments must be a list of {email_id, user_id} objects'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        if not assignments:
+            return Response({'message': 'No emails assigned', 'updated': 0})
+        
+        user_ids = set(assignments.values())
+        missing = user_ids - set(User.objects.filter(id__in=user_ids).values_list('id', flat=True))
+        if missing:
+            return Response(
+                {'error': 'User not found', 'user_ids': sorted(missing)},
+                status=status.HTTP_404_NOT_FOUND
+            )
+        
+        # One WHEN per agent, covering all of that agent's emails
+        emails_by_user = {}
+        for email_id, user_id in assignments.items():
+            emails_by_user.setdefault(user_id, []).append(email_id)
+        
+        now = timezone.now()
+        updated = Email.objects.filter(id__in=assignments).update(
+            assigned_to=Case(*(
+                When(id__in=email_ids, then=Value(user_id))
+                for user_id, email_ids in emails_by_user.items()
+            )),
+            assigned_at=now,
+            status='processing',
+            updated_at=now
+        )
+        
+        return Response({
+            'message': f'{updated} emails assigned',
+            'updated': updated
+        })
+    
     @action(detail=True, methods=['post'])
     def reprocess(self, request, pk=None):
         """Reprocess email with AI"""
         email_obj = self.get_object()
         
-        # Queue for processing
-        process_email_task.delay(email_obj.id)
+        # Queue for processing; Claude is never called in the request cycle
+        result = process_email_task.delay(email_obj.id)
         
         return Response({
             'message': 'Email queued for reprocessing',
-            'email_id': email_obj.id
-        })
+            'email_id': email_obj.id,
+            'task_id': result.id
+        }, status=status.HTTP_202_ACCEPTED)
     
     @action(detail=True, methods=['post'])
     def escalate(self, request, pk=None):
         """Manually escalate email"""
-        email_obj = self.get_object()
         reason = request.data.get('reason', 'Manual escalation')
         
-        email_obj.requires_escalation = True
-        email_obj.escalation_reason = reason
-        email_obj.status = 'escalated'
-        email_obj.save()
+        # UPDATE by primary key; the row is never loaded
+        updated = Email.objects.filter(pk=pk).update(
+            requires_escalation=True,
+            escalation_reason=reason,
+            status='escalated',
+            updated_at=timezone.now()
+        )
+        if not updated:
+            return Response(
+                {'error': 'Email not found'},
+                status=status.HTTP_404_NOT_FOUND
+            )
         
-        return Response({
+        return fast_json({
             'message': 'Email escalated successfully',
-            'email': EmailDetailSerializer(email_obj).data
+            'email': {
+                'id': int(pk),
+                'status': 'escalated',
+                'requires_escalation': True,
+                'escalation_reason': reason
+            }
         })
     
     @action(detail=True, methods=['post'])
     def mark_spam(self, request, pk=None):
         """Mark email as spam"""
-        email_obj = self.get_object()
-        
-        email_obj.status = 'spam'
-        email_obj.save()
+        # Nothing is returned, so the row is never loaded
+        updated = Email.objects.filter(pk=pk).update(status='spam', updated_at=timezone.now())
+        if not updated:
+            return Response(
+                {'error': 'Email not found'},
+                status=status.HTTP_404_NOT_FOUND
+            )
         
-        return Response({
+        return fast_json({
             'message': 'Email marked as spam'
         })
     
     @action(detail=False, methods=['get'])
     def stats(self, request):
         """Get email statistics"""
-        queryset = self.get_queryset()
-        
-        stats = {
-            'total': queryset.count(),
-            'new': queryset.filter(status='new').count(),
-            'processing': queryset.filter(status='processing').count(),
-            'pending_review': queryset.filter(status='pending_review').count(),
-            'replied': queryset.filter(status='replied').count(),
-            'escalated': queryset.filter(status='escalated').count(),
-            'closed': queryset.filter(status='closed').count(),
+        # Dashboards poll this; serve every caller from one computation per TTL
+        status_param = request.query_params.get('status', '')
+        stats = cache.get_or_set(
+            f'{STATS_CACHE_KEY_PREFIX}:{status_param}',
+            lambda: self._compute_stats(self.get_queryset()),
+            STATS_CACHE_TIMEOUT
+        )
+        
+        return Response(stats)
+    
+    def _compute_stats(self, queryset):
+        """Status counts plus category and priority breakdowns"""
+        # Every status count in one scan
+        stats = queryset.aggregate(
+            total=Count('id'),
+            **{
+                status_name: Count('id', filter=Q(status=status_name))
+                for status_name in STATS_STATUSES
+            }
+        )
+        stats.update({
+            # order_by() keeps Meta.ordering out of the grouped queries
             'by_category': list(
-                queryset.values('category__name').annotate(count=Count('id'))
+                queryset.values('category__name').annotate(count=Count('id')).order_by()
             ),
             'by_priority': list(
-                queryset.values('priority').annotate(count=Count('id'))
+                queryset.values('priority').annotate(count=Count('id')).order_by()
             ),
-        }
+        })
         
-        return Response(stats)
+        return stats
 
 
 class EmailReplyViewSet(viewsets.ModelViewSet):
@@ -152,11 +337,43 @@ class EmailReplyViewSet(viewsets.ModelViewSet):
     filter_backends = [DjangoFilterBackend, filters.OrderingFilter]
     filterset_fields = ['email', 'status', 'source']
     ordering = ['-created_at']
+    pagination_class = EmailReplyCursorPagination
     
     def get_queryset(self):
-        return EmailReply.objects.select_related(
-            'email', 'created_by', 'reviewed_by'
-        ).prefetch_related('knowledge_base_articles')
+        queryset = EmailReply.objects.all()
+        
+        if self.action == 'list':
+            # The serializer reads only the email id, the users' names and article
+            # titles; titles are aggregated in the same query, no M2M prefetch
+            return queryset.select_related('created_by', 'reviewed_by').only(
+                'email', 'body', 'source', 'status', 'ai_confidence',
+                'review_notes', 'reviewed_at', 'sent_at', 'created_at', 'updated_at',
+                'created_by__first_name', 'created_by__last_name',
+                'reviewed_by__first_name', 'reviewed_by__last_name',
+            ).annotate(
+                article_titles=ArrayAgg(
+                    'knowledge_base_articles__title',
+                    filter=Q(knowledge_base_articles__isnull=False),
+                    default=Value([])
+                )
+            )
+        
+        if self.action == 'retrieve':
+            queryset = queryset.prefetch_related(
+                'knowledge_base_articles__category',
+                'knowledge_base_articles__created_by'
+            )
+        else:
+            queryset = queryset.prefetch_related(ARTICLE_TITLES_PREFETCH)
+        
+        return queryset.select_related('email', 'created_by', 'reviewed_by')
+    
+    def get_serializer_class(self):
+        if self.action == 'list':
+            return EmailReplyListSerializer
+        if self.action == 'retrieve':
+            return EmailReplyDetailSerializer
+        return EmailReplySerializer
     
     def perform_create(self, serializer):
         """Set created_by when creating reply"""
@@ -165,7 +382,6 @@ class EmailReplyViewSet(viewsets.ModelViewSet):
     @action(detail=True, methods=['post'])
     def review(self, request, pk=None):
         """Approve, reject, or modify a reply"""
-        reply_obj = self.get_object()
         serializer = ReplyApprovalSerializer(data=request.data)
         
         if not serializer.is_valid():
@@ -175,62 +391,70 @@ class EmailReplyViewSet(viewsets.ModelViewSet):
         action_type = data['action']
         
         try:
-            if action_type == 'approve':
-                reply_obj.status = 'approved'
-                reply_obj.reviewed_by = request.user
-                reply_obj.reviewed_at = timezone.now()
-                reply_obj.review_notes = data.get('review_notes', '')
-                reply_obj.save()
+            # One transaction per review; concurrent reviews of the same reply
+            # wait on the row lock instead of interleaving their writes
+            with transaction.atomic():
+                reply_obj = EmailReply.objects.select_for_update().filter(pk=pk).first()
+                if reply_obj is None:
+                    return Response(
+                        {'error': 'Reply not found'},
+                        status=status.HTTP_404_NOT_FOUND
+                    )
                 
-                # Send if requested
-                if data.get('send_immediately'):
-                    sender = EmailSenderService()
-                    sender.send_reply(reply_obj.email, reply_obj)
+                if action_type == 'approve':
+                    reply_obj.status = 'approved'
+                    reply_obj.reviewed_by = request.user
+                    reply_obj.reviewed_at = timezone.now()
+                    reply_obj.review_notes = data.get('review_notes', '')
+                    reply_obj.save(update_fields=REVIEW_FIELDS)
+                    
+                    # Queue sending if requested
+                    if data.get('send_immediately'):
+                        transaction.on_commit(lambda: send_reply_task.delay(reply_obj.id))
+                    
+                    return Response({
+                        'message': 'Reply approved' + (' and queued for sending' if data.get('send_immediately') else ''),
+                        'reply': review_summary(reply_obj)
+                    })
                 
-                return Response({
-                    'message': 'Reply approved' + (' and sent' if data.get('send_immediately') else ''),
-                    'reply': EmailReplySerializer(reply_obj).data
-                })
-            
-            elif action_type == 'reject':
-                reply_obj.status = 'rejected'
-                reply_obj.reviewed_by = request.user
-                reply_obj.reviewed_at = timezone.now()
-                reply_obj.review_notes = data.get('review_notes', '')
-                reply_obj.save()
+                elif action_type == 'reject':
+                    reply_obj.status = 'rejected'
+                    reply_obj.reviewed_by = request.user
+                    reply_obj.reviewed_at = timezone.now()
+                    reply_obj.review_notes = data.get('review_notes', '')
+                    reply_obj.save(update_fields=REVIEW_FIELDS)
+                    
+                    return Response({
+                        'message': 'Reply rejected',
+                        'reply': review_summary(reply_obj)
+                    })
                 
-                return Response({
-                    'message': 'Reply rejected',
-                    'reply': EmailReplySerializer(reply_obj).data
-                })
-            
-            elif action_type == 'modify':
-                # Create new reply with modifications
-                new_reply = EmailReply.objects.create(
-                    email=reply_obj.email,
-                    body=data['modified_body'],
-                    source='ai_modified',
-                    status='approved',
-                    created_by=request.user,
-                    reviewed_by=request.user,
-                    reviewed_at=timezone.now(),
-                    review_notes=data.get('review_notes', 'Modified from AI suggestion')
-                )
-                
-                # Mark old reply as rejected
-                reply_obj.status = 'rejected'
-                reply_obj.review_notes = 'Modified version created'
-                reply_obj.save()
-                
-                # Send if requested
-                if data.get('send_immediately'):
-                    sender = EmailSenderService()
-                    sender.send_reply(new_reply.email, new_reply)
-                
-                return Response({
-                    'message': 'Reply modified and saved',
-                    'reply': EmailReplySerializer(new_reply).data
-                })
+                elif action_type == 'modify':
+                    # Create new reply with modifications
+                    new_reply = EmailReply.objects.create(
+                        email_id=reply_obj.email_id,
+                        body=data['modified_body'],
+                        source='ai_modified',
+                        status='approved',
+                        created_by=request.user,
+                        reviewed_by=request.user,
+                        reviewed_at=timezone.now(),
+                        review_notes=data.get('review_notes', 'Modified from AI suggestion')
+                    )
+                    
+                    # Mark old reply as rejected
+                    reply_obj.status = 'rejected'
+                    reply_obj.review_notes = 'Modified version created'
+                    reply_obj.save(update_fields=['status', 'review_notes', 'updated_at'])
+                    
+                    # Queue sending if requested
+                    if data.get('send_immediately'):
+                        transaction.on_commit(lambda: send_reply_task.delay(new_reply.id))
+                    
+                    return Response({
+                        'message': 'Reply modified and saved',
+                        'reply': review_summary(new_reply)
+                    })
         
         except Exception as e:
             logger.error(f"Error reviewing reply: {e}")
@@ -250,21 +474,14 @@ class EmailReplyViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_400_BAD_REQUEST
             )
         
-        try:
-            sender = EmailSenderService()
-            sender.send_reply(reply_obj.email, reply_obj)
-            
-            return Response({
-                'message': 'Reply sent successfully',
-                'reply': EmailReplySerializer(reply_obj).data
-            })
+        # SMTP runs on the email queue; the request only enqueues
+        result = send_reply_task.delay(reply_obj.id)
         
-        except Exception as e:
-            logger.error(f"Error sending reply: {e}")
-            return Response(
-                {'error': str(e)},
-                status=status.HTTP_500_INTERNAL_SERVER_ERROR
-            )
+        return Response({
+            'message': 'Reply queued for sending',
+            'reply': EmailReplySerializer(reply_obj).data,
+            'task_id': result.id
+        }, status=status.HTTP_202_ACCEPTED)
 
 
 class EmailCategoryViewSet(viewsets.ModelViewSet):
@@ -294,15 +511,63 @@ class KnowledgeBaseViewSet(viewsets.ModelViewSet):
     def perform_create(self, serializer):
         serializer.save(created_by=self.request.user)
     
+    @action(detail=False, methods=['post'])
+    def bulk_import(self, request):
+        """
+        Create many articles at once
+        
+        Body: a list of articles in the same shape as a single create. All are
+        validated first; then they are written with multi-row INSERTs.
+        """
+        serializer = self.get_serializer(data=request.data, many=True)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        
+        articles = KnowledgeBase.objects.bulk_create(
+            [
+                KnowledgeBase(created_by=request.user, **item)
+                for item in serializer.validated_data
+            ],
+            batch_size=500
+        )
+        
+        # bulk_create sends no post_save, so the signal handler never sees these
+        invalidate_kb_search_cache()
+        
+        return Response({
+            'message': f'{len(articles)} articles imported',
+            'ids': [article.id for article in articles]
+        }, status=status.HTTP_201_CREATED)
+    
     @action(detail=False, methods=['get'])
     def search_by_keywords(self, request):
         """Search knowledge base by keywords"""
-        keywords = request.query_params.get('keywords', '').split(',')
+        keywords = [
+            keyword.strip()
+            for keyword in request.query_params.get('keywords', '').split(',')
+            if keyword.strip()
+        ]
+        if not keywords:
+            return Response([])
         
-        queryset = self.get_queryset().filter(
-            is_active=True,
-            keywords__overlap=keywords
-        )
+        def search():
+            # keywords is a JSON array; ?| matches any of its strings via kb_keywords_gin
+            queryset = self.filter_queryset(self.get_queryset()).filter(
+                is_active=True,
+                keywords__has_any_keys=keywords
+            ).only(*KB_ARTICLE_FIELDS)
+            return list(self.get_serializer(queryset, many=True).data)
+        
+        # Serialized matches are cached per keyword set and filters; only the
+        # page number is left out of the key, pages are cut from the cached list
+        params = dict(request.query_params.lists())
+        if self.paginator is not None:
+            params.pop(self.paginator.page_query_param, None)
+        params['keywords'] = sorted(set(keywords))
+        results = get_kb_search_results(urlencode(sorted(params.items()), doseq=True), search)
+        
+        page = self.paginate_queryset(results)
+        if page is not None:
+            return self.get_paginated_response(page)
         
-        serializer = self.get_serializer(queryset, many=True)
-        return Response(serializer.data)
\ No newline at end of file
+        return Response(results)
@@ -2,8 +2,10 @@
 Celery configuration for async task processing
 """
 import os
+from datetime import timedelta
 from celery import Celery
 from celery.schedules import crontab
+from django.conf import settings
 
 # Set default Django settings
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings.development')
@@ -16,16 +18,40 @@ app.config_from_object('django.conf:settings', namespace='CELERY')
 # Auto-discover tasks from all registered apps
 app.autodiscover_tasks()
 
+# Dedicated queues so slow work can't hold up fetching or sending:
+#   celery -A config worker -Q ai_queue --prefetch-multiplier=1 --concurrency=4
+#   celery -A config worker -Q fetch_queue,celery --concurrency=2
+#   celery -A config worker -Q email_queue --pool=gevent --concurrency=100
+# Claude calls take seconds, so AI workers reserve one task at a time; SMTP
+# sends wait on the network, not the CPU, hence the I/O pool.
+app.conf.task_routes = {
+    'apps.emails.tasks.process_email_task': {'queue': 'ai_queue'},
+    'apps.emails.tasks.bulk_process_emails_task': {'queue': 'ai_queue'},
+    'apps.emails.tasks.fetch_emails_task': {'queue': 'fetch_queue'},
+    'apps.emails.tasks.send_reply_task': {'queue': 'email_queue'},
+}
+
 # Celery Beat Schedule (Periodic Tasks)
 app.conf.beat_schedule = {
+    # The name predates the shorter interval. DatabaseScheduler never deletes
+    # entries dropped from this dict, so a rename would leave the old
+    # every-minute PeriodicTask running alongside the new one
     'fetch-emails-every-minute': {
         'task': 'apps.emails.tasks.fetch_emails_task',
-        'schedule': crontab(minute='*/1'),  # Every 1 minute
+        # Pooled IMAP connections make frequent polls cheap (no login per run)
+        'schedule': timedelta(seconds=settings.EMAIL_FETCH_INTERVAL),
+        # A poll still queued when the next is due is dropped, not stacked up
+        'options': {'expires': settings.EMAIL_FETCH_INTERVAL},
     },
     'generate-daily-metrics': {
         'task': 'apps.analytics.tasks.generate_daily_metrics_task',
         'schedule': crontab(hour=0, minute=5),  # Daily at 00:05
     },
+    'refresh-today-metrics': {
+        'task': 'apps.analytics.tasks.generate_daily_metrics_task',
+        'schedule': crontab(minute=30),  # Hourly, today's partial row
+        'kwargs': {'date': 'today'},
+    },
     'cleanup-old-logs': {
         'task': 'apps.emails.tasks.cleanup_old_logs_task',
         'schedule': crontab(hour=2, minute=0, day_of_week=0),  # Weekly on Sunday at 2 AM
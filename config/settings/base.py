@@ -94,6 +94,18 @@ DATABASES = {
         'PORT': env('DB_PORT'),
         'ATOMIC_REQUESTS': True,
         'CONN_MAX_AGE': 600,
+        # Persistent connections are checked before reuse instead of failing mid-request
+        'CONN_HEALTH_CHECKS': True,
+        # Required when connecting through pgbouncer in transaction pooling mode
+        'DISABLE_SERVER_SIDE_CURSORS': env.bool('DB_DISABLE_SERVER_SIDE_CURSORS', default=False),
+    }
+}
+
+# Cache
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': env('REDIS_URL', default='redis://localhost:6379/0'),
     }
 }
 
@@ -162,6 +174,14 @@ CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
 CELERY_TIMEZONE = TIME_ZONE
 CELERY_BEAT_SCHEDULER = 'django_celery_beat.schedulers:DatabaseScheduler'
+# Claude-bound tasks run for seconds: don't let one worker hoard queued
+# emails behind a slow call. Only idempotent tasks opt into acks_late, since
+# a redelivered process_email_task could send the customer a second reply
+CELERY_WORKER_PREFETCH_MULTIPLIER = 1
+# Nothing reads most task results; tasks that feed a chord or whose ids
+# the API hands out (process/send/bulk) opt back in with ignore_result=False
+CELERY_TASK_IGNORE_RESULT = True
+CELERY_RESULT_EXPIRES = 3600  # seconds
 
 # Email Settings
 EMAIL_IMAP_HOST = env('EMAIL_IMAP_HOST')
@@ -177,9 +197,12 @@ EMAIL_USE_TLS = True
 ANTHROPIC_API_KEY = env('ANTHROPIC_API_KEY')
 
 # Email Agent Settings
-EMAIL_FETCH_INTERVAL = 60  # seconds
+EMAIL_FETCH_INTERVAL = 10  # seconds; fetch beat schedule in config/celery.py
 EMAIL_AUTO_REPLY_THRESHOLD = 0.85  # Confidence threshold for auto-reply
 MAX_EMAIL_PROCESSING_TIME = 300  # seconds
+CLAUDE_MAX_CONCURRENCY = 10  # Concurrent Claude requests for batch classification
+# Skip follow-ups to already replied threads at IMAP SEARCH time (they stay unread on the server)
+EMAIL_FETCH_EXCLUDE_REPLIED_THREADS = env.bool('EMAIL_FETCH_EXCLUDE_REPLIED_THREADS', default=False)
 SENSITIVE_FIELDS = ['password', 'ssn', 'credit_card', 'card_number']
 
 # Logging